@@ -5,11 +5,15 @@ facilitate using TARDIS for data analysis. Users that need fine-grained
 control are encouraged to build their own functions.
 """
 
+import logging
+
 import joblib
 
 import numpy as np
 
-from tardis.euclidicity import Euclidicity
+from tardis.neighbours import NeighbourIndex
+from tardis.parallel import score_blocks
+from tardis.parallel import split_threads
 from tardis.utils import estimate_scales
 
 
@@ -25,6 +29,14 @@ def calculate_euclidicity(
     k=20,
     n_jobs=1,
     return_dimensions=False,
+    backend="processes",
+    chunk_size=None,
+    n_threads=1,
+    tolerance=None,
+    neighbours="kdtree",
+    leaf_size=40,
+    n_trees=10,
+    per_dimension=False,
 ):
     """Convenience function for calculating Euclidicity of a point cloud.
 
@@ -33,17 +45,58 @@ def calculate_euclidicity(
     best and fastest Euclidicity calculation, but this comes at the cost
     of configurability.
 
+    The calculation uses a budget of `n_jobs` cores, with `n_threads`
+    threads for every persistent homology calculation; the remaining
+    factor is used for parallel workers with the given `backend`, which
+    must be one of "processes", "threads", or "sequential". Each task
+    comprises `chunk_size` query points; if not set, query points are
+    split into a few balanced chunks per worker.
+
+    If `tolerance` is set, the grid of scales of each query point is
+    traversed from coarse to fine resolutions, stopping once the scores
+    have converged within this tolerance.
+
+    Neighbours are searched with the `neighbours` backend, which must be
+    one of "kdtree", "balltree", "brute", or "rpforest". The latter is
+    approximate but fast for high-dimensional data; its accuracy depends
+    on `leaf_size` and `n_trees`, and its recall on a sample of query
+    points is logged. See :class:`tardis.neighbours.NeighbourIndex` for
+    details.
+
+    If `per_dimension` is set, features are only matched within the same
+    dimension when calculating Bottleneck distances.
+
     TODO: Document me :-)
     """
     r_, R_, s_, S_ = r, R, s, S
-    query_points = X if Y is None else Y
+
+    # Keep track of whether query points and data set coincide so that
+    # they only need to be shared once with parallel workers.
+    X = np.asarray(X)
+    query_points = X if Y is None else np.asarray(Y)
+
+    # The same index serves scale estimation and Euclidicity calculations.
+    index = NeighbourIndex(
+        X, backend=neighbours, leaf_size=leaf_size, n_trees=n_trees
+    )
 
     if all([x is not None for x in [r_, R_, s_, S_]]):
-        scales = [dict()] * len(query_points)
+        scales = None
     else:
-        scales = estimate_scales(X, query_points, k)
+        scales = estimate_scales(X, query_points, k, index=index)
+
+    if index.approximate and len(query_points) > 0:
+        if scales is not None:
+            estimate_recall(index, query_points, k=k, seed=0)
 
-    euclidicity = Euclidicity(
+        estimate_recall(
+            index,
+            query_points,
+            radius=S_ if scales is None else scales[:, 3],
+            seed=0,
+        )
+
+    params = dict(
         max_dim=max_dim,
         n_steps=n_steps,
         r=r_,
@@ -51,26 +104,160 @@ def calculate_euclidicity(
         s=s_,
         S=S_,
         method="ripser",
-        data=X,
+        tolerance=tolerance,
+        per_dimension=per_dimension,
     )
 
-    def _process(x, scale=None):
-        scores, dimensions = euclidicity(X, x, **scale)
-
-        score = np.mean(np.nan_to_num(scores))
-        dimension = np.mean(dimensions)
+    n_jobs, n_threads = split_threads(n_jobs, n_threads)
 
-        return score, dimension
+    output = [
+        aggregate_euclidicity(scores, dimensions)
+        for scores, dimensions in score_blocks(
+            X,
+            query_points,
+            split_query_points(len(query_points), n_jobs, chunk_size),
+            scales,
+            params,
+            n_jobs=n_jobs,
+            backend=backend,
+            n_threads=n_threads,
+            index=index,
+        )
+    ]
 
-    output = joblib.Parallel(n_jobs=n_jobs)(
-        joblib.delayed(_process)(x, scale)
-        for x, scale in zip(query_points, scales)
+    # Without any query points, there are no blocks to concatenate.
+    euclidicity = np.concatenate([e for (e, _) in output] or [[]])
+    persistent_intrinsic_dimension = np.concatenate(
+        [d for (_, d) in output] or [[]]
     )
 
-    euclidicity = np.asarray([e for (e, _) in output])
-    persistent_intrinsic_dimension = np.asarray([d for (_, d) in output])
-
     if return_dimensions:
         return euclidicity, persistent_intrinsic_dimension
     else:
         return euclidicity
+
+
+def estimate_recall(
+    index, query_points, k=None, radius=None, n_samples=100, seed=None
+):
+    """Estimate recall of queries on a sample of query points.
+
+    Approximate neighbour search may miss neighbours used for scale
+    estimation or points of an annulus, so its recall is reported via
+    logging. A warning is issued if the recall is low, in which case
+    more trees or larger leaves should be used.
+
+    Parameters
+    ----------
+    index : :class:`tardis.neighbours.NeighbourIndex`
+        Index to evaluate.
+
+    query_points : np.array of shape ``(M, d)``
+        Query points.
+
+    k : int or None
+        If set, evaluate nearest-neighbour queries with this number of
+        neighbours, as used for scale estimation.
+
+    radius : float, np.array of shape ``(M, )``, or None
+        If set, evaluate radius queries with this radius, i.e. the
+        largest outer radius of every query point.
+
+    n_samples : int
+        Maximum number of query points to evaluate.
+
+    seed : int, instance of `np.random.Generator`, or `None`
+        Seed for the random number generator, or an instance of such
+        a generator.
+
+    Returns
+    -------
+    float
+        Fraction of all neighbours found by exact search that are also
+        found by the index.
+    """
+    rng = np.random.default_rng(seed)
+    sample = rng.choice(
+        len(query_points), min(len(query_points), n_samples), replace=False
+    )
+
+    if np.ndim(radius) > 0:
+        radius = np.asarray(radius)[sample]
+
+    recall = index.recall(query_points[sample], k=k, radius=radius)
+    queries = "nearest-neighbour" if k is not None else "radius"
+
+    logger = logging.getLogger()
+    logger.info(f"Recall of {queries} queries: {recall:.2f}")
+
+    if recall < 0.9:
+        logger.warning(
+            f"Low recall of {queries} queries ({recall:.2f}); consider "
+            f"using more trees or larger leaves"
+        )
+
+    return recall
+
+
+def aggregate_euclidicity(scores, dimensions):
+    """Aggregate Euclidicity scores over all scales of each query point.
+
+    Parameters
+    ----------
+    scores : np.array of shape ``(M, n_cells)``
+        Euclidicity estimates of each query point, as returned by
+        :meth:`Euclidicity.score_many`.
+
+    dimensions : np.array of shape ``(M, n_cells)``
+        Persistent intrinsic dimension values of each query point, as
+        returned by :meth:`Euclidicity.score_many`. NaN values denote
+        padding and are ignored.
+
+    Returns
+    -------
+    Tuple of np.array, np.array
+        Mean Euclidicity and mean persistent intrinsic dimension of each
+        query point. Missing scores, arising from empty annuli, count as
+        zero.
+    """
+    valid = ~np.isnan(dimensions)
+
+    n_valid = valid.sum(axis=1)
+    score = np.where(valid, np.nan_to_num(scores), 0.0).sum(axis=1)
+    dimension = np.where(valid, dimensions, 0.0).sum(axis=1)
+
+    return score / n_valid, dimension / n_valid
+
+
+def split_query_points(n_query_points, n_jobs, chunk_size=None):
+    """Split query points into blocks for parallel processing.
+
+    Parameters
+    ----------
+    n_query_points : int
+        Number of query points.
+
+    n_jobs : int
+        Number of parallel jobs, following the conventions of `joblib`.
+
+    chunk_size : int or None
+        If set, use blocks of this size, with the last block possibly
+        being smaller. Else, use a few blocks per job to even out the
+        load.
+
+    Returns
+    -------
+    List of np.array
+        Indices of the query points in each block.
+    """
+    if chunk_size is not None:
+        return [
+            np.arange(start, min(start + chunk_size, n_query_points))
+            for start in range(0, n_query_points, chunk_size)
+        ]
+
+    if n_query_points == 0:
+        return []
+
+    n_blocks = min(n_query_points, 4 * joblib.effective_n_jobs(n_jobs))
+    return np.array_split(np.arange(n_query_points), n_blocks)
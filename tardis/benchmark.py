@@ -0,0 +1,373 @@
+"""Benchmarks for Euclidicity calculations.
+
+This script measures the runtime of the main parts of our Euclidicity
+calculations on synthetic data sets, covering different sample sizes,
+dimensions, and grid resolutions. Results are written in a format that
+can be tracked across versions.
+
+Usage:
+    python -m tardis.benchmark -o benchmark.json
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+from importlib.metadata import version, PackageNotFoundError
+
+import numpy as np
+import pandas as pd
+
+from tardis.api import calculate_euclidicity
+from tardis.euclidicity import Euclidicity
+from tardis.persistent_homology import GUDHI
+from tardis.persistent_homology import Ripser
+from tardis.shapes import sample_from_sphere
+from tardis.shapes import sample_from_wedged_spheres
+
+# Scales for all Euclidicity benchmarks, following the parameters of our
+# experiments with synthetic data sets.
+SCALES = dict(r=0.05, R=0.45, s=0.2, S=0.6)
+
+
+def measure(fn, n_repeats):
+    """Measure runtime of a function.
+
+    Parameters
+    ----------
+    fn : callable
+        Function to measure. Will be called without arguments.
+
+    n_repeats : int
+        Number of repetitions.
+
+    Returns
+    -------
+    dict
+        Minimum, median, and mean runtime in seconds.
+    """
+    timings = []
+
+    for _ in range(n_repeats):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+
+    return {
+        "min": np.min(timings),
+        "median": np.median(timings),
+        "mean": np.mean(timings),
+    }
+
+
+def benchmark_persistent_homology(sizes, dimensions, n_repeats, seed):
+    """Benchmark persistent homology wrappers on spheres.
+
+    Parameters
+    ----------
+    sizes : list of int
+        Number of points to sample.
+
+    dimensions : list of int
+        Dimensions of the spheres, which are also used as the maximum
+        dimension for persistent homology calculations.
+
+    n_repeats : int
+        Number of repetitions of each measurement.
+
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    list of dict
+        Runtime of each configuration.
+    """
+    results = []
+
+    for d in dimensions:
+        for n in sizes:
+            X = sample_from_sphere(n, d, seed=seed)
+
+            for method, vr in [("gudhi", GUDHI()), ("ripser", Ripser())]:
+                results.append(
+                    {
+                        "benchmark": "persistent_homology",
+                        "method": method,
+                        "n": n,
+                        "dimension": d,
+                        **measure(lambda: vr(X, d), n_repeats),
+                    }
+                )
+
+    return results
+
+
+def benchmark_euclidicity(
+    sizes, dimensions, n_steps, n_query_points, n_repeats, seed
+):
+    """Benchmark Euclidicity functor per query point on wedged spheres.
+
+    Parameters
+    ----------
+    sizes : list of int
+        Number of points to sample.
+
+    dimensions : list of int
+        Intrinsic dimensions of the wedged spheres.
+
+    n_steps : list of int
+        Number of steps of the grid of annuli.
+
+    n_query_points : int
+        Number of query points. Runtimes are reported per point.
+
+    n_repeats : int
+        Number of repetitions of each measurement.
+
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    list of dict
+        Runtime of each configuration.
+    """
+    results = []
+
+    for d in dimensions:
+        for n in sizes:
+            X = sample_from_wedged_spheres(n, d, seed=seed)
+            query_points = X[:n_query_points]
+
+            for steps in n_steps:
+                euclidicity = Euclidicity(
+                    max_dim=d,
+                    n_steps=steps,
+                    data=X,
+                    method="ripser",
+                    **SCALES,
+                )
+
+                timings = measure(
+                    lambda: [euclidicity(X, x) for x in query_points],
+                    n_repeats,
+                )
+
+                results.append(
+                    {
+                        "benchmark": "euclidicity",
+                        "method": "ripser",
+                        "n": n,
+                        "dimension": d,
+                        "n_steps": steps,
+                        **{
+                            name: value / len(query_points)
+                            for name, value in timings.items()
+                        },
+                    }
+                )
+
+    return results
+
+
+def benchmark_api(sizes, dimensions, n_steps, n_query_points, n_repeats, seed):
+    """Benchmark end-to-end Euclidicity calculations on wedged spheres.
+
+    Parameters
+    ----------
+    sizes : list of int
+        Number of points to sample.
+
+    dimensions : list of int
+        Intrinsic dimensions of the wedged spheres.
+
+    n_steps : list of int
+        Number of steps of the grid of annuli.
+
+    n_query_points : int
+        Number of query points.
+
+    n_repeats : int
+        Number of repetitions of each measurement.
+
+    seed : int
+        Seed for the random number generator.
+
+    Returns
+    -------
+    list of dict
+        Runtime of each configuration.
+    """
+    results = []
+
+    for d in dimensions:
+        for n in sizes:
+            X = sample_from_wedged_spheres(n, d, seed=seed)
+            query_points = X[:n_query_points]
+
+            for steps in n_steps:
+                timings = measure(
+                    lambda: calculate_euclidicity(
+                        X,
+                        query_points,
+                        max_dim=d,
+                        n_steps=steps,
+                        **SCALES,
+                    ),
+                    n_repeats,
+                )
+
+                results.append(
+                    {
+                        "benchmark": "api",
+                        "method": "ripser",
+                        "n": n,
+                        "dimension": d,
+                        "n_steps": steps,
+                        **timings,
+                    }
+                )
+
+    return results
+
+
+def get_metadata(args):
+    """Collect information about the benchmark environment."""
+    packages = {}
+
+    for package in ["numpy", "scikit-learn", "gudhi", "giotto-ph"]:
+        try:
+            packages[package] = version(package)
+        except PackageNotFoundError:
+            packages[package] = None
+
+    return {
+        "timestamp": datetime.datetime.now().isoformat(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "python": platform.python_version(),
+        "packages": packages,
+        "arguments": vars(args),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        help="Output file (optional). If not set, results will be printed "
+        "to standard output in JSON format. Else, the output format will "
+        "be guessed from the file extension ('.json' or '.csv').",
+    )
+    parser.add_argument(
+        "-b",
+        "--benchmark",
+        nargs="+",
+        default=["persistent_homology", "euclidicity", "api"],
+        choices=["persistent_homology", "euclidicity", "api"],
+        help="Benchmarks to run",
+    )
+    parser.add_argument(
+        "-n",
+        "--sizes",
+        nargs="+",
+        default=[20, 40, 60],
+        type=int,
+        help="Sample sizes for persistent homology benchmarks",
+    )
+    parser.add_argument(
+        "-N",
+        "--data-sizes",
+        nargs="+",
+        default=[1000, 2000],
+        type=int,
+        help="Sample sizes for Euclidicity benchmarks",
+    )
+    parser.add_argument(
+        "-d",
+        "--dimensions",
+        nargs="+",
+        default=[1, 2],
+        type=int,
+        help="Dimensions of the sampled spaces",
+    )
+    parser.add_argument(
+        "--num-steps",
+        nargs="+",
+        default=[5, 10],
+        type=int,
+        help="Number of steps for annulus sampling",
+    )
+    parser.add_argument(
+        "-q",
+        "--num-query-points",
+        default=10,
+        type=int,
+        help="Number of query points for Euclidicity benchmarks",
+    )
+    parser.add_argument(
+        "-r",
+        "--repeats",
+        default=3,
+        type=int,
+        help="Number of repetitions of each measurement",
+    )
+    parser.add_argument(
+        "--seed",
+        default=42,
+        type=int,
+        help="Random number generator seed",
+    )
+
+    args = parser.parse_args()
+
+    results = []
+
+    if "persistent_homology" in args.benchmark:
+        results.extend(
+            benchmark_persistent_homology(
+                args.sizes, args.dimensions, args.repeats, args.seed
+            )
+        )
+
+    if "euclidicity" in args.benchmark:
+        results.extend(
+            benchmark_euclidicity(
+                args.data_sizes,
+                args.dimensions,
+                args.num_steps,
+                args.num_query_points,
+                args.repeats,
+                args.seed,
+            )
+        )
+
+    if "api" in args.benchmark:
+        results.extend(
+            benchmark_api(
+                args.data_sizes,
+                args.dimensions,
+                args.num_steps,
+                args.num_query_points,
+                args.repeats,
+                args.seed,
+            )
+        )
+
+    if args.output is not None and args.output.endswith(".csv"):
+        pd.DataFrame(results).to_csv(args.output, index=False)
+    else:
+        output = {"metadata": get_metadata(args), "results": results}
+
+        if args.output is None:
+            json.dump(output, sys.stdout, indent=2)
+        else:
+            with open(args.output, "w") as f:
+                json.dump(output, f, indent=2)
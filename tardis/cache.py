@@ -0,0 +1,281 @@
+"""Caching of intermediate results.
+
+This module provides caches for the expensive parts of Euclidicity
+calculations, making it possible to reuse them between runs.
+"""
+
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from tardis.filesystem import atomic_write
+
+
+class DiskCache:
+    """Persistent, content-addressed cache on disk.
+
+    Entries are stored as individual files, named after a hash of their
+    key. Reading an entry marks it as recently used; once the cache size
+    exceeds its limit, the least recently used entries are removed. The
+    cache may be shared by multiple processes.
+    """
+
+    def __init__(self, directory, max_size=2**30):
+        """Initialise new cache.
+
+        Parameters
+        ----------
+        directory : str
+            Directory for storing cache entries. Will be created if it
+            does not exist.
+
+        max_size : int
+            Maximum size of the cache in bytes. Since processes keep
+            track of the cache size independently, the limit can be
+            exceeded temporarily when multiple processes use the cache.
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+        os.makedirs(directory, exist_ok=True)
+
+        # The cache size requires a walk over all entries, so we only
+        # calculate it once an entry is stored.
+        self.size = None
+
+    def __getstate__(self):
+        # The cache size is being tracked per process, so we recompute
+        # it when storing the first entry after unpickling.
+        return {"directory": self.directory, "max_size": self.max_size}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def key(*parts):
+        """Calculate key for a sequence of objects.
+
+        Parameters
+        ----------
+        parts : iterable
+            Objects that identify a cache entry. Arrays are identified
+            by their content, lists and tuples are traversed, and all
+            other objects are identified by their representation.
+
+        Returns
+        -------
+        str
+            Hexadecimal digest of all objects.
+        """
+        h = hashlib.sha256()
+
+        def _update(part):
+            if isinstance(part, np.ndarray):
+                part = np.ascontiguousarray(part)
+                h.update(f"array{part.shape}{part.dtype}".encode())
+                h.update(part.tobytes())
+            elif isinstance(part, (list, tuple)):
+                h.update(f"sequence{len(part)}".encode())
+                for x in part:
+                    _update(x)
+            else:
+                h.update(repr(part).encode())
+
+        for part in parts:
+            _update(part)
+
+        return h.hexdigest()
+
+    def get(self, key, default=None):
+        """Get cache entry.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry, as calculated by :meth:`key`.
+
+        default : object
+            Value to return if no entry exists.
+
+        Returns
+        -------
+        object
+            Cached value or `default`.
+        """
+        filename = self._filename(key)
+
+        try:
+            with open(filename, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return default
+
+        # Mark the entry as recently used; it may have been evicted by
+        # another process in the meantime, which is fine.
+        try:
+            os.utime(filename)
+        except OSError:
+            pass
+
+        return value
+
+    def put(self, key, value):
+        """Store cache entry.
+
+        Parameters
+        ----------
+        key : str
+            Key of the entry, as calculated by :meth:`key`.
+
+        value : object
+            Value to store. Must be serialisable.
+        """
+        if self.size is None:
+            self.size = sum(size for _, _, size in self._entries())
+
+        filename = self._filename(key)
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+
+        # Other processes must never see incomplete entries.
+        with atomic_write(filename) as f:
+            pickle.dump(value, f)
+
+        self.size += os.path.getsize(filename)
+
+        if self.size > self.max_size:
+            self._evict()
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.pkl")
+
+    def _entries(self):
+        for root, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith(".pkl"):
+                    continue
+
+                filename = os.path.join(root, filename)
+
+                try:
+                    stat = os.stat(filename)
+                except OSError:
+                    continue
+
+                yield filename, stat.st_mtime, stat.st_size
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self.size = sum(size for _, _, size in entries)
+
+        # Remove entries until we are comfortably below the limit, so
+        # that we do not have to evict upon every insertion.
+        for filename, _, size in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+            self.size -= size
+
+
+class ModelDiagramCache:
+    """In-memory cache of persistence diagrams of model spaces.
+
+    Vietoris--Rips filtrations are equivariant under scaling, so the
+    diagram of an annulus with radii `r` and `s` is the diagram of an
+    annulus with radii `r / s` and 1, scaled by `s`. This cache stores
+    diagrams of such canonical annuli, with the number of points and the
+    ratio of radii being bucketed, thus turning the calculation of model
+    diagrams into a lookup.
+
+    Notes
+    -----
+    The sampling function must respect the scaling behaviour described
+    above. This is the case for all annulus sampling functions of
+    :mod:`tardis.shapes`.
+    """
+
+    def __init__(self, sample_fn, vr, resolution=0.05, growth=1.1):
+        """Initialise new cache.
+
+        Parameters
+        ----------
+        sample_fn : callable
+            Function for sampling from the model space, following the
+            conventions of the `model_sample_fn` parameter of
+            :class:`tardis.euclidicity.Euclidicity`.
+
+        vr : callable
+            Persistent homology calculation, as provided by the wrappers
+            in :mod:`tardis.persistent_homology`.
+
+        resolution : float
+            Resolution of the ratio of inner and outer radius. Ratios
+            are rounded down to multiples of this value.
+
+        growth : float
+            Growth factor of the buckets for the number of points. The
+            number of points is rounded to the nearest power of this
+            value, so the relative error is at most ``growth - 1``.
+        """
+        self.sample_fn = sample_fn
+        self.vr = vr
+        self.resolution = resolution
+        self.growth = growth
+
+        self.diagrams = {}
+
+    def __call__(self, n, r, s, d, profiler=None):
+        """Get persistence diagram of model space.
+
+        Parameters
+        ----------
+        n : int
+            Number of points to sample
+
+        r : float
+            Inner radius of annulus
+
+        s : float
+            Outer radius of annulus
+
+        d : int
+            Intrinsic dimension of model space
+
+        profiler : :class:`tardis.profiling.Profiler` or None
+            If set, counts persistent homology calculations, i.e. cache
+            misses, as `n_model_ph_calls`.
+
+        Returns
+        -------
+        PersistenceDiagram or None
+            Persistence diagram of the model space, following the
+            conventions of the persistent homology calculation.
+        """
+        n = int(round(self.growth ** round(np.log(n) / np.log(self.growth))))
+
+        # Allow for rounding errors, so that ratios that are multiples of
+        # the resolution are not assigned to the previous bucket.
+        bucket = int(np.floor(r / s / self.resolution + 1e-9))
+        ratio = bucket * self.resolution
+
+        key = (n, bucket, d)
+
+        if key not in self.diagrams:
+            X = self.sample_fn(n=n, r=ratio, R=1.0, d=d)
+            self.diagrams[key], _ = self.vr(X, d)
+
+            if profiler is not None:
+                profiler.add("n_model_ph_calls")
+
+        barcodes = self.diagrams[key]
+
+        if barcodes is None:
+            return None
+        else:
+            return barcodes * s
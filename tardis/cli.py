@@ -8,13 +8,27 @@ it will calculate Euclidicity scores.
 import argparse
 import colorlog
 import functools
-import joblib
 import os
+import pickle
 
 import numpy as np
 import pandas as pd
 
-from tardis.euclidicity import Euclidicity
+from tardis.api import aggregate_euclidicity
+from tardis.api import estimate_recall
+from tardis.api import split_query_points
+
+from tardis.cache import DiskCache
+
+from tardis.neighbours import NeighbourIndex
+
+from tardis.output import ResultWriter
+
+from tardis.parallel import iter_score_blocks
+from tardis.parallel import split_threads
+
+from tardis.profiling import STAGES
+from tardis.profiling import summarise
 
 from tardis.shapes import sample_from_annulus
 from tardis.shapes import sample_from_constant_curvature_annulus
@@ -58,6 +72,13 @@ def setup():
         "standard output. If set, will guess the output format based "
         "on the file extension.",
     )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="If set, keep existing results in the output file and only "
+        "process the remaining query points. Requires the same input and "
+        "seed as the original run.",
+    )
 
     euclidicity_group = parser.add_argument_group("Euclidicity calculations")
 
@@ -101,6 +122,48 @@ def setup():
         type=int,
         help="Number of steps for annulus sampling",
     )
+    euclidicity_group.add_argument(
+        "--tolerance",
+        type=float,
+        help="If set, traverse scales from coarse to fine and stop once "
+        "the mean and maximum score change by less than this tolerance",
+    )
+    euclidicity_group.add_argument(
+        "--max-annulus-size",
+        type=int,
+        help="If set, subsample larger annuli to this number of points",
+    )
+    euclidicity_group.add_argument(
+        "--landmarks",
+        default="farthest",
+        choices=["farthest", "random"],
+        help="Subsampling method for annuli",
+    )
+    euclidicity_group.add_argument(
+        "--method",
+        default="ripser",
+        choices=["gudhi", "ripser", "sparse"],
+        help="Persistent homology calculation method. The 'sparse' method "
+        "approximates Rips filtrations, trading accuracy for speed.",
+    )
+    euclidicity_group.add_argument(
+        "--epsilon",
+        default=0.5,
+        type=float,
+        help="Approximation parameter of the 'sparse' method",
+    )
+    euclidicity_group.add_argument(
+        "--bottleneck-error",
+        type=float,
+        help="If set, calculate approximate Bottleneck distances with this "
+        "additive error",
+    )
+    euclidicity_group.add_argument(
+        "--per-dimension",
+        action="store_true",
+        help="If set, only match features of the same dimension when "
+        "calculating Bottleneck distances",
+    )
     parser.add_argument(
         "-f",
         "--fixed-annulus",
@@ -130,6 +193,109 @@ def setup():
         help="Random number generator seed for reproducible experiments",
     )
 
+    execution_group = parser.add_argument_group("Execution")
+
+    execution_group.add_argument(
+        "-j",
+        "--num-jobs",
+        default=-1,
+        type=int,
+        help="Total number of cores to use (-1 uses all cores). These are "
+        "split into parallel jobs and threads per job.",
+    )
+    execution_group.add_argument(
+        "-t",
+        "--num-threads",
+        default=1,
+        type=int,
+        help="Number of threads per job for persistent homology "
+        "calculations and linear algebra routines",
+    )
+    execution_group.add_argument(
+        "--backend",
+        default="processes",
+        choices=["processes", "threads", "sequential"],
+        help="Execution backend for parallel jobs",
+    )
+    execution_group.add_argument(
+        "--neighbours",
+        default="kdtree",
+        choices=["kdtree", "balltree", "brute", "rpforest"],
+        help="Backend for neighbour search. 'brute' is exact and suitable "
+        "for high-dimensional data, while 'rpforest' is approximate but "
+        "faster; its recall is reported.",
+    )
+    execution_group.add_argument(
+        "--leaf-size",
+        default=40,
+        type=int,
+        help="Maximum number of points in the leaves of search trees",
+    )
+    execution_group.add_argument(
+        "--num-trees",
+        default=10,
+        type=int,
+        help="Number of trees for 'rpforest' neighbour search. More trees "
+        "and larger leaves improve recall, in particular for "
+        "high-dimensional data.",
+    )
+    execution_group.add_argument(
+        "--max-memory",
+        default=256,
+        type=float,
+        help="Memory budget in MB for distance calculations of brute-force "
+        "neighbour search",
+    )
+    execution_group.add_argument(
+        "--chunk-size",
+        type=int,
+        help="Number of query points per task. If not set, query points "
+        "will be split into a few chunks per job.",
+    )
+
+    cache_group = parser.add_argument_group("Caching")
+
+    cache_group.add_argument(
+        "--cache-dir",
+        type=str,
+        help="If set, store persistent homology results in this directory "
+        "and reuse them in subsequent runs",
+    )
+    cache_group.add_argument(
+        "--cache-size",
+        default=1024,
+        type=float,
+        help="Maximum size of the cache in MB",
+    )
+    cache_group.add_argument(
+        "--index",
+        type=str,
+        help="If set, store the neighbour index of the sampled data set in "
+        "this file and reuse it in subsequent runs on the same sample",
+    )
+    cache_group.add_argument(
+        "--cache-model-diagrams",
+        action="store_true",
+        help="If set, calculate persistence diagrams of model spaces only "
+        "once per bucket of sample size and ratio of radii, and rescale "
+        "them afterwards",
+    )
+
+    profiling_group = parser.add_argument_group("Profiling")
+
+    profiling_group.add_argument(
+        "--profile",
+        action="store_true",
+        help="If set, show a summary of the time spent in every stage of "
+        "the calculation, together with statistics of annuli",
+    )
+    profiling_group.add_argument(
+        "--trace",
+        type=str,
+        help="If set, write timings and counters of every query point to "
+        "this file in CSV format. Implies '--profile'.",
+    )
+
     experimental_group = parser.add_argument_group("Experimental")
 
     experimental_group.add_argument(
@@ -162,25 +328,92 @@ if __name__ == "__main__":
         seed=rng,
     )
 
+    writer = ResultWriter(args.output, resume=args.resume)
+
+    if args.resume and writer.n_rows > 0:
+        previous = writer.read()[:, : query_points.shape[1]]
+
+        if len(previous) > len(query_points) or not np.allclose(
+            previous, query_points[: len(previous)]
+        ):
+            raise RuntimeError(
+                "Existing output does not match query points; make sure "
+                "to use the same input, seed, and sampling parameters."
+            )
+
+        logger.info(f"Resuming after {len(previous)} query points")
+
+    # Load a stored index if it matches the sampled data set; else, build
+    # a new one and store it if desired.
+    index = None
+
+    if args.index is not None and os.path.exists(args.index):
+        try:
+            index = NeighbourIndex.load(args.index)
+            valid = (
+                index.backend == args.neighbours
+                and index.leaf_size == args.leaf_size
+                and index.n_trees == args.num_trees
+                and index.matches(X)
+            )
+        except (EOFError, AttributeError, pickle.UnpicklingError):
+            valid = False
+
+        if valid:
+            logger.info(f"Using neighbour index from {args.index}")
+        else:
+            logger.warning(
+                f"Neighbour index in {args.index} does not match data set "
+                f"or backend; rebuilding it"
+            )
+
+            index = None
+
+    if index is None:
+        index = NeighbourIndex(
+            X,
+            backend=args.neighbours,
+            leaf_size=args.leaf_size,
+            n_trees=args.num_trees,
+            max_memory=int(args.max_memory * 1024**2),
+        )
+
+        if args.index is not None:
+            index.save(args.index)
+
     r, R, s, S = args.r, args.R, args.s, args.S
     k = args.num_neighbours
 
     # Check whether we have to perform scale estimation on a per-point
-    # basis. If not, we just supply an empty dict.
+    # basis. If not, we do not supply any scales.
     if all([x is not None for x in [r, R, s, S]]):
         logger.info(
             f"Using global scales r = {r:.2f}, R = {R:.2f}, "
             f"s = {s:.2f}, S = {S:.2f}"
         )
 
-        scales = [dict()] * len(query_points)
+        scales = None
     else:
         logger.info(
             f"Performing scale estimation with k = {k} since no "
             f"parameters have been provided by the client."
         )
 
-        scales = estimate_scales(X, query_points, k)
+        scales = estimate_scales(X, query_points, k, index=index)
+
+    # Approximate neighbour search may miss neighbours for scale
+    # estimation or points of an annulus, so we report its recall on
+    # a sample of query points.
+    if index.approximate:
+        if scales is not None:
+            estimate_recall(index, query_points, k=k, seed=rng)
+
+        estimate_recall(
+            index,
+            query_points,
+            radius=args.S if scales is None else scales[:, 3],
+            seed=rng,
+        )
 
     max_dim = args.dimension
     n_steps = args.num_steps
@@ -188,6 +421,13 @@ if __name__ == "__main__":
     logger.info(f"Maximum dimension: {max_dim}")
     logger.info(f"Number of steps for local sampling: {n_steps}")
 
+    n_jobs, n_threads = split_threads(args.num_jobs, args.num_threads)
+
+    logger.info(
+        f"Using {args.backend} backend with {n_jobs} jobs and "
+        f"{n_threads} threads per job"
+    )
+
     # Choose a sampling procedure for the inner comparison of sampled
     # annuli from the data space with model spaces.
     if args.fixed_annulus:
@@ -202,48 +442,112 @@ if __name__ == "__main__":
         logger.info("Using Euclidean annulus model space")
         model_sample_fn = sample_from_annulus
 
-    euclidicity = Euclidicity(
+    if args.cache_dir is not None:
+        logger.info(f"Using cache in {args.cache_dir}")
+        cache = DiskCache(args.cache_dir, int(args.cache_size * 2**20))
+    else:
+        cache = None
+
+    params = dict(
         max_dim=max_dim,
         n_steps=n_steps,
         r=args.r,
         R=args.R,
         s=args.s,
         S=args.S,
-        method="ripser",
-        data=X,
+        method=args.method,
+        epsilon=args.epsilon,
+        bottleneck_error=args.bottleneck_error,
+        per_dimension=args.per_dimension,
         model_sample_fn=model_sample_fn,
+        cache=cache,
+        cache_model_diagrams=args.cache_model_diagrams,
+        tolerance=args.tolerance,
+        max_annulus_size=args.max_annulus_size,
+        landmarks=args.landmarks,
+        seed=0 if args.seed is None else args.seed,
     )
 
-    def _process(x, scale=None):
-        scores, dimensions = euclidicity(X, x, **scale)
-
+    # Only process query points for which no results are available. The
+    # results are written in order, so we only have to skip a prefix.
+    remaining = np.arange(writer.n_rows, len(query_points))
+    blocks = [
+        remaining[indices]
+        for indices in split_query_points(
+            len(remaining), n_jobs, args.chunk_size
+        )
+    ]
+
+    # Number of scales that have been evaluated, which only varies in
+    # adaptive mode.
+    n_scales = []
+
+    profile = args.profile or args.trace is not None
+    records = []
+
+    for indices, (scores, dimensions, *block_records) in zip(
+        blocks,
+        iter_score_blocks(
+            X,
+            query_points,
+            blocks,
+            scales,
+            params,
+            n_jobs=n_jobs,
+            backend=args.backend,
+            n_threads=n_threads,
+            profile=profile,
+            index=index,
+        ),
+    ):
         # Aggregate over all scores that we find. We could pick
         # a different aggregation here!
-        score = np.mean(np.nan_to_num(scores))
-        dimension = np.mean(dimensions)
+        euclidicity, dimension = aggregate_euclidicity(scores, dimensions)
 
-        return score, dimension
+        df = pd.DataFrame(query_points[indices]).add_prefix("X")
+        df["euclidicity"] = euclidicity
+        df["persistent_intrinsic_dimension"] = dimension
 
-    output = joblib.Parallel(n_jobs=-1)(
-        joblib.delayed(_process)(x, scale)
-        for x, scale in zip(query_points, scales)
-    )
+        writer.write(df)
 
-    df = pd.DataFrame(
-        output, columns=["euclidicity", "persistent_intrinsic_dimension"]
-    )
+        n_scales.extend(np.sum(~np.isnan(dimensions), axis=1))
 
-    df = pd.concat([pd.DataFrame(query_points).add_prefix("X"), df], axis=1)
+        if profile:
+            for point_index, record in zip(indices, block_records[0]):
+                records.append(dict(index=point_index, **record))
 
-    if args.output is None:
-        print(df.to_csv(index=False))
-    else:
-        extension = os.path.splitext(args.output)[1]
-        if extension == ".tsv":
-            df.to_csv(args.output, index=False, sep="\t")
-        elif extension == ".csv":
-            df.to_csv(args.output, index=False)
-        elif extension == ".npy":
-            np.save(args.output, df)
-        elif extension == ".npz":
-            np.savez(args.output, df)
+    writer.close()
+
+    if args.trace is not None:
+        pd.DataFrame(records).fillna(0).to_csv(args.trace, index=False)
+
+    if profile and records:
+        summary = summarise(records)
+
+        for stage in STAGES:
+            logger.info(
+                f"{stage}: {summary[f'{stage}_time']:.2f}s "
+                f"({100 * summary[f'{stage}_share']:.1f}%)"
+            )
+
+        logger.info(
+            f"Evaluated {summary.get('n_cells', 0)} cells, of which "
+            f"{summary.get('n_nan_cells', 0)} yielded no score"
+        )
+        logger.info(
+            f"Calculated persistent homology of "
+            f"{summary.get('n_data_ph_calls', 0)} annuli and "
+            f"{summary.get('n_model_ph_calls', 0)} model spaces"
+        )
+
+        if "mean_annulus_size" in summary:
+            logger.info(
+                f"Annulus size: mean = {summary['mean_annulus_size']:.2f}, "
+                f"max = {summary['max_annulus_size']}"
+            )
+
+    if args.tolerance is not None and n_scales:
+        logger.info(
+            f"Evaluated {np.mean(n_scales):.2f} scales per query point on "
+            f"average (min = {np.min(n_scales)}, max = {np.max(n_scales)})"
+        )
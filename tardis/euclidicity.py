@@ -1,11 +1,102 @@
 """Euclidicity example implementation."""
 
+import logging
+import time
+
 import numpy as np
 
-from sklearn.neighbors import KDTree
+from scipy.spatial.distance import cdist
+
+from tardis.cache import ModelDiagramCache
+
+from tardis.neighbours import BruteForceSearch
+from tardis.neighbours import NeighbourIndex
 
 from tardis.persistent_homology import GUDHI
+from tardis.persistent_homology import PersistenceDiagram
 from tardis.persistent_homology import Ripser
+from tardis.profiling import NullProfiler
+
+
+def _farthest_point_sampling(X, n):
+    """Select landmarks by farthest point sampling.
+
+    Only the distances to the latest landmark are calculated in every
+    step, so the memory required is linear in the number of points.
+
+    Parameters
+    ----------
+    X : np.array of shape ``(N, d)``
+        Input points.
+
+    n : int
+        Number of landmarks to select.
+
+    Returns
+    -------
+    np.array
+        Indices of the landmarks. The first landmark is always the point
+        with index 0; every subsequent landmark is the point farthest
+        away from all previous landmarks.
+    """
+    indices = [0]
+    min_distances = cdist(X[:1], X)[0]
+
+    for _ in range(n - 1):
+        index = int(np.argmax(min_distances))
+        indices.append(index)
+        min_distances = np.minimum(
+            min_distances, cdist(X[index : index + 1], X)[0]
+        )
+
+    return np.asarray(indices)
+
+
+def _coarse_to_fine(n_steps):
+    """Group cells of a square grid into levels of increasing resolution.
+
+    The first level consists of the corners of the grid. Every further
+    level bisects the intervals between indices of previous levels, such
+    that the levels successively refine the grid.
+
+    Parameters
+    ----------
+    n_steps : int
+        Number of steps of the grid along each axis.
+
+    Returns
+    -------
+    List of list of tuples
+        Levels of cells, with each cell being given as a pair of
+        indices. Every cell of the grid is part of exactly one level.
+    """
+    levels = [sorted({0, n_steps - 1})]
+    intervals = [(0, n_steps - 1)]
+
+    while intervals:
+        level = []
+        bisected_intervals = []
+
+        for a, b in intervals:
+            if b - a > 1:
+                m = (a + b) // 2
+                level.append(m)
+                bisected_intervals.extend([(a, m), (m, b)])
+
+        if level:
+            levels.append(level)
+
+        intervals = bisected_intervals
+
+    level_of_index = {i: k for k, level in enumerate(levels) for i in level}
+
+    cells = [[] for _ in levels]
+    for i in range(n_steps):
+        for j in range(n_steps):
+            level = max(level_of_index[i], level_of_index[j])
+            cells[level].append((i, j))
+
+    return cells
 
 
 class Euclidicity:
@@ -22,6 +113,17 @@ class Euclidicity:
         data=None,
         method="gudhi",
         model_sample_fn=None,
+        n_threads=1,
+        cache=None,
+        cache_model_diagrams=False,
+        tolerance=None,
+        max_annulus_size=None,
+        landmarks="farthest",
+        seed=0,
+        epsilon=0.5,
+        bottleneck_error=None,
+        per_dimension=False,
+        profiler=None,
     ):
         """Initialise new instance of functor.
 
@@ -53,16 +155,20 @@ class Euclidicity:
             annulus. Note that the complexity of the function is
             quadratic in the number of steps.
 
-        data : np.array or None
-            If set, prepares a tree for nearest-neighbour and radius
+        data : np.array, :class:`tardis.neighbours.NeighbourIndex`, or None
+            If set, prepares an index for nearest-neighbour and radius
             queries on the input data set. This can lead to substantial
-            speed improvements in practice.
+            speed improvements in practice. An existing index, e.g. one
+            that has been used for scale estimation, is used as-is.
 
         method : str
             Persistent homology calculation method. At the moment, only
-            "gudhi" and "ripser" are supported. "gudhi" is better for a
-            small, low-dimensional data set, while "ripser" scales well
-            to larger, high-dimensional point clouds.
+            "gudhi", "ripser", and "sparse" are supported. "gudhi" is
+            better for a small, low-dimensional data set, while "ripser"
+            scales well to larger, high-dimensional point clouds. The
+            "sparse" method approximates persistent homology by a sparse
+            Rips complex, which is useful for higher dimensions, where
+            exact calculations become prohibitive.
 
         model_sample_fn : callable
             Function to be called for sampling from a comparison space.
@@ -72,6 +178,68 @@ class Euclidicity:
             sample function is provided, the class will default to
             compare the topological features with those of fixed
             Euclidean annulus.
+
+        n_threads : int
+            Number of threads for each persistent homology calculation.
+            Only the "ripser" method supports multiple threads.
+
+        cache : :class:`tardis.cache.DiskCache` or None
+            If set, stores the barcodes of all annuli in this cache and
+            reuses them in subsequent calculations. When comparing to
+            a fixed annulus, Bottleneck distances are cached as well.
+
+        cache_model_diagrams : bool
+            If set, persistence diagrams of the model space are only
+            calculated once for every combination of bucketed number of
+            points, ratio of radii, and dimension, and then rescaled to
+            the annulus at hand. See
+            :class:`tardis.cache.ModelDiagramCache` for details. Has no
+            effect without a sampling function.
+
+        tolerance : float or None
+            If set, enables an adaptive mode that evaluates the grid of
+            annuli from coarse to fine resolutions and stops as soon as
+            an additional level of resolution changes neither the mean
+            nor the maximum of the scores by more than `tolerance`. The
+            number of scores being returned thus varies per point, and
+            scores are no longer ordered by radii.
+
+        max_annulus_size : int or None
+            If set, annuli with more points are subsampled to this size
+            prior to persistent homology calculations, thus bounding the
+            runtime and memory of each calculation regardless of the
+            local density.
+            When sampling from a model space, the same number of points
+            is used.
+
+        landmarks : str
+            Subsampling method for annuli. Must be either "farthest" for
+            farthest point sampling or "random" for random sampling.
+
+        seed : int
+            Seed for the random number generator of "random" subsampling.
+            The generator is reset for every annulus, so results do not
+            depend on the order of calculations.
+
+        epsilon : float
+            Approximation parameter of the "sparse" method. Persistence
+            diagrams are ``(1 + epsilon)``-approximations of the exact
+            diagrams. Smaller values increase both accuracy and runtime.
+
+        bottleneck_error : float or None
+            If set, calculate approximate Bottleneck distances, which
+            differ from the exact distances by at most this value. Else,
+            distances are exact.
+
+        per_dimension : bool
+            If set, features are only matched within the same dimension
+            when calculating Bottleneck distances. By default, features
+            of all dimensions are matched jointly, which may match
+            features of different dimensions to each other.
+
+        profiler : :class:`tardis.profiling.Profiler` or None
+            If set, collects timings and counters of all calculations,
+            with one record per query point. Can also be set per call.
         """
         self.r = r
         self.R = R
@@ -80,24 +248,69 @@ class Euclidicity:
 
         self.n_steps = n_steps
         self.max_dim = max_dim
+        self.tolerance = tolerance
+
+        if landmarks not in ["farthest", "random"]:
+            raise RuntimeError(f"Unknown landmark selection {landmarks}.")
+
+        self.max_annulus_size = max_annulus_size
+        self.landmarks = landmarks
+        self.seed = seed
+
+        # Grid cells, i.e. pairs of indices of inner and outer radii, to
+        # evaluate. In adaptive mode, they are grouped into levels of
+        # increasing resolution; else, there is only a single level.
+        if tolerance is None:
+            self._levels = [
+                [(i, j) for i in range(n_steps) for j in range(n_steps)]
+            ]
+        else:
+            self._levels = _coarse_to_fine(n_steps)
 
         self.model_sample_fn = model_sample_fn
 
+        self.method = method
+        self.cache = cache
+        self.bottleneck_error = bottleneck_error
+        self.per_dimension = per_dimension
+        self.profiler = profiler
+
         if method == "gudhi":
-            self.vr = GUDHI()
+            self.vr = GUDHI(
+                error=bottleneck_error, stack_diagrams=not per_dimension
+            )
         elif method == "ripser":
-            self.vr = Ripser()
+            self.vr = Ripser(
+                stack_diagrams=not per_dimension,
+                n_threads=n_threads,
+                error=bottleneck_error,
+            )
+        elif method == "sparse":
+            self.vr = GUDHI(
+                sparse=epsilon,
+                error=bottleneck_error,
+                stack_diagrams=not per_dimension,
+            )
+
+            # Approximate barcodes depend on the approximation parameter,
+            # so the latter needs to be part of all cache keys.
+            self.method = (method, epsilon)
         else:
             raise RuntimeError("No persistent homology calculation selected.")
 
-        # Prepare KD tree to speed up annulus calculations. We make this
+        if model_sample_fn is not None and cache_model_diagrams:
+            self.model_diagrams = ModelDiagramCache(model_sample_fn, self.vr)
+        else:
+            self.model_diagrams = None
+
+        # Prepare index to speed up annulus calculations. We make this
         # configurable to permit both types of workflows.
-        if data is not None:
-            self.tree = KDTree(data)
+        if data is None or isinstance(data, NeighbourIndex):
+            self.index = data
         else:
-            self.tree = None
+            self.index = NeighbourIndex(data)
 
-    def __call__(self, X, x, **kwargs):
+    def __call__(self, X, x, scales=None, profiler=None, **kwargs):
         """Calculate Euclidicity of a specific point.
 
         Parameters
@@ -109,6 +322,16 @@ class Euclidicity:
         x : np.array, tensor, or iterable of shape ``(d, )``
             Input point.
 
+        scales : np.array of shape ``(4, )`` or None
+            If set, provides the `r`, `R`, `s`, and `S` parameters of
+            the point, in this order, as returned for a single point by
+            :func:`tardis.utils.estimate_scales`. Parameters that are
+            set explicitly take precedence.
+
+        profiler : :class:`tardis.profiling.Profiler` or None
+            If set, collects timings and counters of this calculation.
+            Will default to global `profiler` parameter if not set.
+
         Other Parameters
         ----------------
         r : float, optional
@@ -134,67 +357,430 @@ class Euclidicity:
             array depends on the number of scales. The second array will
             contain the persistent intrinsic dimension (PID) values.
         """
+        if scales is not None:
+            kwargs = dict(zip(["r", "R", "s", "S"], scales), **kwargs)
+
         r = kwargs.get("r", self.r)
         R = kwargs.get("R", self.R)
         s = kwargs.get("s", self.s)
         S = kwargs.get("S", self.S)
 
+        profiler = self._get_profiler(profiler)
+        profiler.begin()
+
+        # Every annulus of the grid is contained in the largest annulus,
+        # i.e. the one with radii `r` and `S`. We collect its points and
+        # their pairwise distances only once and extract all subsequent
+        # annuli from there.
+        with profiler.stage("neighbour_search"):
+            indices, inner, outer = self._query_grid(
+                X,
+                np.asarray([x]),
+                *(np.full(1, v, float) for v in [r, R, s, S]),
+            )
+
+        with profiler.stage("annulus_extraction"):
+            neighbourhood = self._get_neighbourhood(
+                X, indices[0], inner[0], outer[0]
+            )
+
+        return self._calculate_grid(neighbourhood, r, R, s, S, profiler)
+
+    def score_many(self, X, Y, scales=None, profiler=None, **kwargs):
+        """Calculate Euclidicity of a block of points.
+
+        This is the batch version of the functor call. Neighbourhoods
+        of all query points are obtained with a single radius query, so
+        that callers can dispatch fewer but larger units of work.
+
+        Parameters
+        ----------
+        X : np.array or tensor of shape ``(N, d)``
+            Input data set. Must be compatible with the persistent
+            homology calculations.
+
+        Y : np.array of shape ``(M, d)``
+            Query points.
+
+        scales : np.array of shape ``(M, 4)`` or None
+            If set, provides the `r`, `R`, `s`, and `S` parameters of
+            every query point, as returned by
+            :func:`tardis.utils.estimate_scales`. Parameters that are
+            set explicitly take precedence.
+
+        profiler : :class:`tardis.profiling.Profiler` or None
+            If set, collects timings and counters of this calculation.
+            The time of the joint radius query is split evenly among all
+            query points. Will default to global `profiler` parameter if
+            not set.
+
+        Other Parameters
+        ----------------
+        r : float or np.array of shape ``(M, )``, optional
+            Minimum inner radius of annulus, either for all points or
+            per point. Will default to global `r` parameter if not set.
+
+        R : float or np.array of shape ``(M, )``, optional
+            Maximum inner radius of annulus, either for all points or
+            per point. Will default to global `R` parameter if not set.
+
+        s : float or np.array of shape ``(M, )``, optional
+            Minimum outer radius of annulus, either for all points or
+            per point. Will default to global `s` parameter if not set.
+
+        S : float or np.array of shape ``(M, )``, optional
+            Maximum outer radius of annulus, either for all points or
+            per point. Will default to global `S` parameter if not set.
+
+        Returns
+        -------
+        Tuple of np.array, np.array
+            2D arrays of shape ``(M, n_cells)``, containing Euclidicity
+            estimates and persistent intrinsic dimension (PID) values,
+            respectively. Each row corresponds to the output of calling
+            the functor on the respective query point. Should the number
+            of scales differ between query points, shorter rows will be
+            padded with NaN in *both* arrays.
+        """
+        Y = np.asarray(Y)
+
+        if scales is not None:
+            kwargs = dict(
+                zip(["r", "R", "s", "S"], np.asarray(scales).T), **kwargs
+            )
+
+        r, R, s, S = (
+            np.full(len(Y), kwargs.get(name, getattr(self, name)), float)
+            for name in ["r", "R", "s", "S"]
+        )
+
+        profiler = self._get_profiler(profiler)
+
+        start = time.perf_counter()
+        all_indices, all_inner, all_outer = self._query_grid(X, Y, r, R, s, S)
+        query_time = time.perf_counter() - start
+
+        output = []
+
+        for i, indices in enumerate(all_indices):
+            profiler.begin()
+            profiler.add("neighbour_search", query_time / len(Y))
+
+            with profiler.stage("annulus_extraction"):
+                neighbourhood = self._get_neighbourhood(
+                    X, indices, all_inner[i], all_outer[i]
+                )
+
+            output.append(
+                self._calculate_grid(
+                    neighbourhood, r[i], R[i], s[i], S[i], profiler
+                )
+            )
+
+        n_cells = max([len(scores) for scores, _ in output], default=0)
+
+        scores = np.full((len(Y), n_cells), np.nan)
+        dimensions = np.full((len(Y), n_cells), np.nan)
+
+        for i, (scores_, dimensions_) in enumerate(output):
+            scores[i, : len(scores_)] = scores_
+            dimensions[i, : len(dimensions_)] = dimensions_
+
+        return scores, dimensions
+
+    # Auxiliary method for choosing the profiler of a call; falls back
+    # to a profiler that does not collect anything.
+    def _get_profiler(self, profiler):
+        if profiler is None:
+            profiler = self.profiler
+
+        return NullProfiler() if profiler is None else profiler
+
+    # Auxiliary method for evaluating the full grid of annuli of
+    # a single query point, given its neighbourhood.
+    def _calculate_grid(self, neighbourhood, r, R, s, S, profiler):
+        # Different cells of the grid may end up with the same annulus
+        # on discrete data, so we keep the barcodes for every set of
+        # annulus points around.
+        barcodes_cache = {}
+
         bottleneck_distances = []
         dimensions = []
 
-        for r in np.linspace(r, R, self.n_steps):
-            for s in np.linspace(s, S, self.n_steps):
-                if r < s:
-                    dist, dim = self._calculate_euclidicity(
-                        r, s, X, x, self.max_dim
-                    )
+        inner_radii = np.linspace(r, R, self.n_steps)
+        outer_radii = np.linspace(s, S, self.n_steps)
+
+        # Summary statistics of the scores of all previous levels; used
+        # to check for convergence in adaptive mode.
+        previous = None
+
+        _, _, inner, outer = neighbourhood
+
+        for level in self._levels:
+            level = [
+                (i, j) for i, j in level if inner_radii[i] < outer_radii[j]
+            ]
+            cells = [(inner_radii[i], outer_radii[j]) for i, j in level]
+
+            # Collect the diagrams of all cells of the current level
+            # first so that their distances can be calculated at once.
+            diagrams = [
+                self._calculate_diagrams(
+                    inner_radii[i],
+                    outer_radii[j],
+                    outer[j] & ~inner[i],
+                    neighbourhood,
+                    self.max_dim,
+                    barcodes_cache,
+                    profiler,
+                )
+                for i, j in level
+            ]
 
-                    bottleneck_distances.append(dist)
-                    dimensions.append(dim)
+            with profiler.stage("distance"):
+                distances = self._calculate_distances(cells, diagrams)
+
+            bottleneck_distances.extend(distances)
+            dimensions.extend([dim for _, _, dim in diagrams])
+
+            profiler.add("n_cells", len(cells))
+            profiler.add("n_nan_cells", np.isnan(distances).sum())
+
+            if self.tolerance is None or not bottleneck_distances:
+                continue
+
+            scores = np.nan_to_num(bottleneck_distances)
+            current = np.asarray([np.mean(scores), np.max(scores)])
+
+            if previous is not None:
+                if np.all(np.abs(current - previous) <= self.tolerance):
+                    break
+
+            previous = current
 
         return np.asarray(bottleneck_distances), np.asarray(dimensions)
 
-    # Auxiliary method for performing the 'heavy lifting' when it comes
-    # to Euclidicity calculations.
-    def _calculate_euclidicity(self, r, s, X, x, d):
-        if self.tree is not None:
-            inner_indices = self.tree.query_radius(x.reshape(1, -1), r)[0]
-            outer_indices = self.tree.query_radius(x.reshape(1, -1), s)[0]
-
-            annulus_indices = np.setdiff1d(outer_indices, inner_indices)
-            annulus = X[annulus_indices]
+    # Auxiliary method for radius queries of a block of points with
+    # per-point radii. Returns the indices of all neighbours within `S`
+    # of each query point, sorted by distance, together with boolean
+    # arrays of shape `(n_steps, n)` per query point that indicate which
+    # of its `n` neighbours lie within each inner and outer radius of the
+    # grid, respectively.
+    def _query_grid(self, X, Y, r, R, s, S):
+        if self.index is not None:
+            all_indices, all_distances = self.index.query_radius(Y, S)
         else:
-            annulus = np.asarray(
-                [
-                    np.asarray(p)
-                    for p in X
-                    if np.linalg.norm(x - p) <= s
-                    and np.linalg.norm(x - p) >= r
-                ]
-            )
+            # Without an index, fall back to brute-force search, which is
+            # exact, so results are the same.
+            all_indices, all_distances = BruteForceSearch(X).query_radius(Y, S)
+
+        inner = self._get_members(
+            Y, np.linspace(r, R, self.n_steps), all_indices, all_distances
+        )
+        outer = self._get_members(
+            Y,
+            np.linspace(s, S, self.n_steps),
+            all_indices,
+            all_distances,
+            closed=True,
+        )
+
+        return all_indices, inner, outer
+
+    # Auxiliary method for checking which neighbours of every query point
+    # lie within each of the given radii. With an index, this follows its
+    # radius queries, so that points on the boundary of a ball belong to
+    # it if and only if the index returns them. Otherwise, balls of inner
+    # radii are open and balls of outer radii are closed, i.e. annuli
+    # include both of their radii.
+    def _get_members(self, Y, radii, indices, distances, closed=False):
+        if self.index is not None:
+            members = [
+                self.index.within(Y, radius, indices, distances)
+                for radius in radii
+            ]
+        else:
+            compare = np.less_equal if closed else np.less
+
+            members = [
+                [compare(d, r) for d, r in zip(distances, radius)]
+                for radius in radii
+            ]
+
+        return [np.asarray(m, dtype=bool) for m in zip(*members)]
+
+    # Auxiliary method for collecting the largest annulus around a query
+    # point from its sorted neighbours. Returns the points of the annulus
+    # and the matrix of their pairwise distances, so that every annulus
+    # of the grid is a subset of them, along with the membership arrays
+    # of all radii restricted to the annulus. If the annulus exceeds the
+    # maximum annulus size, the matrix is `None` instead, since only
+    # distances of subsampled annuli are required.
+    def _get_neighbourhood(self, X, indices, inner, outer):
+        # Points within the smallest inner radius are not part of any
+        # annulus of the grid.
+        keep = ~inner[0]
+
+        annulus = np.asarray(X[indices[keep]])
+
+        if (
+            self.max_annulus_size is None
+            or len(annulus) <= self.max_annulus_size
+        ):
+            pairwise_distances = cdist(annulus, annulus)
+        else:
+            pairwise_distances = None
+
+        return annulus, pairwise_distances, inner[:, keep], outer[:, keep]
+
+    # Auxiliary method for performing the 'heavy lifting' when it comes
+    # to Euclidicity calculations. Returns the persistence diagrams of
+    # the annulus and of the model space, together with the dimension.
+    # Diagrams are `None` if no comparison is possible. The annulus is
+    # given by a boolean mask of the points of the neighbourhood.
+    def _calculate_diagrams(
+        self, r, s, members, neighbourhood, d, barcodes_cache, profiler
+    ):
+        annulus, pairwise_distances, _, _ = neighbourhood
+
+        key = members.tobytes()
 
-        barcodes, max_dim = self.vr(annulus, d)
+        if key not in barcodes_cache:
+            with profiler.stage("annulus_extraction"):
+                if pairwise_distances is not None:
+                    D = pairwise_distances[np.ix_(members, members)]
+                else:
+                    D = self._subsample(annulus[members])
+
+            # All points of the annulus are within distance `s` of the
+            # query point, so its diameter is at most `2 * s`. Clipping
+            # the filtration at this scale thus loses no features.
+            with profiler.stage("data_ph"):
+                barcodes_cache[key] = (
+                    *self._calculate_barcodes(D, d, 2 * s, profiler),
+                    len(D),
+                )
+
+            profiler.add("n_annuli")
+            profiler.add("annulus_size", len(D))
+            profiler.maximum("max_annulus_size", len(D))
+
+        barcodes, max_dim, n = barcodes_cache[key]
 
         if max_dim < 0:
-            return np.nan, max_dim
+            return None, None, max_dim
 
-        if self.model_sample_fn is not None:
-            euclidean_annulus = self.model_sample_fn(
-                n=len(annulus), r=r, R=s, d=d
-            )
-            barcodes_euclidean, _ = self.vr(euclidean_annulus, d)
+        if self.model_diagrams is not None:
+            with profiler.stage("model_ph"):
+                barcodes_euclidean = self.model_diagrams(
+                    n=n, r=r, s=s, d=d, profiler=profiler
+                )
+        elif self.model_sample_fn is not None:
+            with profiler.stage("model_sampling"):
+                euclidean_annulus = self.model_sample_fn(n=n, r=r, R=s, d=d)
+
+            with profiler.stage("model_ph"):
+                barcodes_euclidean, _ = self.vr(euclidean_annulus, d)
+
+            profiler.add("n_model_ph_calls")
 
         # No sampling function has been specified. Compare to a fixed
-        # annulus with known persistent homology.
-        #
-        # TODO: Technically, the single feature should be put into
-        # a persistence diagram of the right dimension. Let us not
-        # do that for now (since we stack diagrams anyway).
+        # annulus with known persistent homology, i.e. one connected
+        # component and a single feature in dimension `d - 1`.
         else:
-            barcodes_euclidean = np.asarray([[0, np.inf], [r, s]])
+            diagrams = [np.empty((0, 2)) for _ in range(max(d, 1))]
+            diagrams[0] = np.asarray([[0, np.inf]])
+            diagrams[-1] = np.row_stack((diagrams[-1], [[r, s]]))
+
+            barcodes_euclidean = PersistenceDiagram.from_diagrams(diagrams)
 
         if barcodes_euclidean is None:
-            return np.nan, max_dim
+            return None, None, max_dim
+
+        return barcodes, barcodes_euclidean, max_dim
+
+    # Auxiliary method for calculating the Bottleneck distances of all
+    # pairs of diagrams in a single batch. Pairs without diagrams yield
+    # NaN values.
+    def _calculate_distances(self, cells, diagrams):
+        output = np.full(len(cells), np.nan)
+
+        pending = [
+            k
+            for k, (barcodes, _, _) in enumerate(diagrams)
+            if barcodes is not None
+        ]
+
+        # Distances to a fixed annulus are deterministic, so we may
+        # cache them. This is not the case for sampled annuli.
+        if self.cache is not None and self.model_sample_fn is None:
+            keys = {
+                k: self.cache.key(
+                    "distance",
+                    self.method,
+                    self.bottleneck_error,
+                    self.per_dimension,
+                    diagrams[k][0].points,
+                    diagrams[k][0].offsets,
+                    *cells[k],
+                )
+                for k in pending
+            }
+
+            for k in pending:
+                output[k] = self.cache.get(keys[k], np.nan)
+
+            pending = [k for k in pending if np.isnan(output[k])]
+        else:
+            keys = None
+
+        if pending:
+            output[pending] = self.vr.distances(
+                [diagrams[k][0] for k in pending],
+                [diagrams[k][1] for k in pending],
+            )
+
+        if keys is not None:
+            for k in pending:
+                self.cache.put(keys[k], output[k])
+
+        return output
+
+    # Auxiliary method for subsampling the points of an annulus to the
+    # maximum annulus size. Returns the distance matrix of the subsampled
+    # points, such that only this matrix needs to be calculated.
+    def _subsample(self, X):
+        if len(X) <= self.max_annulus_size:
+            return cdist(X, X)
+
+        if self.landmarks == "farthest":
+            indices = _farthest_point_sampling(X, self.max_annulus_size)
+        else:
+            rng = np.random.default_rng(self.seed)
+            indices = rng.choice(len(X), self.max_annulus_size, replace=False)
+
+        logging.getLogger().debug(
+            f"Subsampled annulus from {len(X)} to {len(indices)} points "
+            f"(ratio = {len(indices) / len(X):.2f})"
+        )
+
+        return cdist(X[indices], X[indices])
+
+    # Auxiliary method for calculating the barcodes of an annulus from
+    # its distance matrix, using the persistent cache if available. Only
+    # actual calculations count as persistent homology calls.
+    def _calculate_barcodes(self, D, d, threshold, profiler):
+        if self.cache is not None:
+            key = self.cache.key("barcodes", self.method, d, D)
+            barcodes = self.cache.get(key)
+
+            if barcodes is not None:
+                return barcodes
+
+        barcodes = self.vr(D, d, metric="precomputed", threshold=threshold)
+        profiler.add("n_data_ph_calls")
+
+        if self.cache is not None:
+            self.cache.put(key, barcodes)
 
-        dist = self.vr.distance(barcodes, barcodes_euclidean)
-        return dist, max_dim
+        return barcodes
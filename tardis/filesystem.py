@@ -0,0 +1,42 @@
+"""File system helpers.
+
+This module collects helpers for writing files that may be read by
+other processes or that must survive interruptions.
+"""
+
+import contextlib
+import os
+import tempfile
+
+
+@contextlib.contextmanager
+def atomic_write(filename):
+    """Open a file for writing such that it is replaced atomically.
+
+    Data are written to a temporary file in the same directory first,
+    which only replaces `filename` once writing has finished. Readers
+    thus never see incomplete files, and an interruption never leaves
+    one behind. If writing fails, the temporary file is removed.
+
+    Parameters
+    ----------
+    filename : str
+        Output file. Its directory must exist.
+
+    Yields
+    ------
+    file object
+        Temporary file, opened in binary mode.
+    """
+    fd, tmp_filename = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(filename)), suffix=".tmp"
+    )
+
+    try:
+        with os.fdopen(fd, "wb") as f:
+            yield f
+
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        os.remove(tmp_filename)
+        raise
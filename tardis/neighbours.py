@@ -0,0 +1,585 @@
+"""Neighbour search for Euclidicity calculations.
+
+This module provides an index for nearest-neighbour and radius queries
+on a data set. The same index can be used for scale estimation and for
+Euclidicity calculations, and it can be stored on disk so that repeated
+runs on the same data set do not have to rebuild it.
+
+Several search backends are available. Trees are exact and fast for
+low-dimensional data, whereas brute-force search and the approximate
+random projection forest are better suited for high-dimensional data.
+"""
+
+import os
+import pickle
+
+import joblib
+
+import numpy as np
+
+from sklearn.neighbors import BallTree
+from sklearn.neighbors import KDTree
+
+from tardis.filesystem import atomic_write
+
+# Available search backends. Only the "rpforest" backend is approximate.
+BACKENDS = ["kdtree", "balltree", "brute", "rpforest"]
+
+# Index that has been loaded from disk last in the current process, keyed
+# by its file and the modification time of the file. Since indices are
+# pickled by reference to their file, this ensures that every process
+# only has to load them once per run. Workers are reused between runs,
+# so we only keep the last index around.
+_loaded = {}
+
+
+class NeighbourIndex:
+    """Index for nearest-neighbour and radius queries on a data set.
+
+    Once an index has been stored on disk, it is pickled by reference to
+    its file, making it cheap to pass to parallel workers.
+    """
+
+    def __init__(
+        self,
+        X,
+        backend="kdtree",
+        leaf_size=40,
+        n_trees=10,
+        seed=0,
+        max_memory=2**28,
+    ):
+        """Build new index.
+
+        Parameters
+        ----------
+        X : np.array of shape ``(N, d)``
+            Input data set.
+
+        backend : str
+            Search backend. Must be one of "kdtree", "balltree", "brute",
+            or "rpforest". The "rpforest" backend uses a forest of random
+            projection trees, which only finds neighbours approximately;
+            use :meth:`recall` to assess its quality.
+
+        leaf_size : int
+            Maximum number of points in the leaves of trees. Has no
+            effect for brute-force search.
+
+        n_trees : int
+            Number of trees of the "rpforest" backend. More trees and
+            larger leaves lead to a higher recall but also to slower
+            queries. High-dimensional data requires substantially more
+            of both than the defaults; check the :meth:`recall`.
+
+        seed : int
+            Seed for the random number generator of the "rpforest"
+            backend.
+
+        max_memory : int
+            Memory budget in bytes for distance calculations of the
+            "brute" backend. See :class:`BruteForceSearch`.
+        """
+        if backend not in BACKENDS:
+            raise RuntimeError(f"Unknown neighbour search backend {backend}.")
+
+        self.fingerprint = joblib.hash(np.asarray(X))
+        self.backend = backend
+        self.leaf_size = leaf_size
+        self.n_trees = n_trees
+        self.filename = None
+
+        if backend == "kdtree":
+            self.searcher = KDTree(X, leaf_size=leaf_size)
+        elif backend == "balltree":
+            self.searcher = BallTree(X, leaf_size=leaf_size)
+        elif backend == "brute":
+            self.searcher = BruteForceSearch(X, max_memory=max_memory)
+        else:
+            self.searcher = _RandomProjectionForest(
+                X, leaf_size=leaf_size, n_trees=n_trees, seed=seed
+            )
+
+    @property
+    def approximate(self):
+        """Return whether queries are approximate."""
+        return self.backend == "rpforest"
+
+    def __len__(self):
+        """Return number of points in the index."""
+        return self.searcher.data.shape[0]
+
+    def __getstate__(self):
+        if self.filename is not None:
+            return {"filename": self.filename}
+
+        return self.__dict__.copy()
+
+    def __setstate__(self, state):
+        if set(state) == {"filename"}:
+            self.__dict__.update(_load(state["filename"]).__dict__)
+        else:
+            self.__dict__.update(state)
+
+    def matches(self, X):
+        """Check whether the index has been built on a data set.
+
+        Parameters
+        ----------
+        X : np.array of shape ``(N, d)``
+            Input data set.
+
+        Returns
+        -------
+        bool
+            True if the index has been built on `X`.
+        """
+        return self.fingerprint == joblib.hash(np.asarray(X))
+
+    def query(self, Y, k):
+        """Find nearest neighbours of query points.
+
+        Parameters
+        ----------
+        Y : np.array of shape ``(M, d)``
+            Query points.
+
+        k : int
+            Number of neighbours.
+
+        Returns
+        -------
+        Tuple of np.array, np.array
+            Distances and indices of the `k` nearest neighbours of every
+            query point, both of shape ``(M, k)``, sorted in ascending
+            order of distance.
+        """
+        return self.searcher.query(Y, k=k, return_distance=True)
+
+    def query_radius(self, Y, radius):
+        """Find all points within a given radius of query points.
+
+        Parameters
+        ----------
+        Y : np.array of shape ``(M, d)``
+            Query points.
+
+        radius : float or np.array of shape ``(M, )``
+            Query radius, either for all points or per point.
+
+        Returns
+        -------
+        Tuple of np.array, np.array
+            Object arrays of length `M`, containing the indices of all
+            neighbours of every query point and their distances, both
+            sorted in ascending order of distance.
+        """
+        return self.searcher.query_radius(
+            Y, radius, return_distance=True, sort_results=True
+        )
+
+    def within(self, Y, radius, indices, distances):
+        """Check which neighbours of query points lie within a radius.
+
+        A neighbour lies within the radius if it would be returned by
+        :meth:`query_radius` with this radius. Trees may or may not
+        return points whose distance is exactly the radius, depending on
+        rounding, so for them, the check requires another query.
+
+        Parameters
+        ----------
+        Y : np.array of shape ``(M, d)``
+            Query points.
+
+        radius : float or np.array of shape ``(M, )``
+            Radius, either for all points or per point.
+
+        indices : sequence of np.array
+            Indices of neighbours of every query point, as returned by
+            :meth:`query_radius` with a radius that is at least `radius`.
+
+        distances : sequence of np.array
+            Distances of these neighbours.
+
+        Returns
+        -------
+        list of np.array
+            Boolean mask of the neighbours within the radius for every
+            query point.
+        """
+        radius = np.full(len(Y), radius, dtype=float)
+
+        if self.backend in ["kdtree", "balltree"]:
+            found = self.searcher.query_radius(
+                Y, radius, return_distance=False
+            )
+            return [np.isin(a, b) for a, b in zip(indices, found)]
+
+        # The other backends return exactly those candidates whose
+        # distance does not exceed the radius, and their candidates do
+        # not depend on the radius.
+        return [d <= r for d, r in zip(distances, radius)]
+
+    def recall(self, Y, k=None, radius=None):
+        """Estimate recall of queries in comparison to exact search.
+
+        Parameters
+        ----------
+        Y : np.array of shape ``(M, d)``
+            Query points. Since exact search is expensive, this should
+            only be a small sample of all query points.
+
+        k : int or None
+            If set, evaluate nearest-neighbour queries with this number
+            of neighbours.
+
+        radius : float, np.array of shape ``(M, )``, or None
+            If set, evaluate radius queries with this radius.
+
+        Returns
+        -------
+        float
+            Fraction of all neighbours found by exact search that are
+            also found by this index. Exact backends always have
+            a recall of 1.0.
+        """
+        exact = BruteForceSearch(self.searcher.data)
+
+        if k is not None:
+            _, expected = exact.query(Y, k=k)
+            _, found = self.query(Y, k)
+        else:
+            expected = exact.query_radius(Y, radius, return_distance=False)
+            found, _ = self.query_radius(Y, radius)
+
+        n_expected = sum(len(indices) for indices in expected)
+        n_found = sum(
+            len(np.intersect1d(a, b)) for a, b in zip(expected, found)
+        )
+
+        return n_found / n_expected if n_expected > 0 else 1.0
+
+    def save(self, filename):
+        """Store index on disk.
+
+        Afterwards, the index is pickled by reference to this file.
+
+        Parameters
+        ----------
+        filename : str
+            Output file
+        """
+        self.filename = None
+
+        # Other processes must never see incomplete indices.
+        with atomic_write(filename) as f:
+            pickle.dump(self, f)
+
+        self.filename = os.path.abspath(filename)
+
+    @classmethod
+    def load(cls, filename):
+        """Load index from disk.
+
+        Parameters
+        ----------
+        filename : str
+            Input file, as created by :meth:`save`.
+
+        Returns
+        -------
+        NeighbourIndex
+            Index stored in the file.
+        """
+        return _load(os.path.abspath(filename))
+
+
+def _load(filename):
+    key = (filename, os.path.getmtime(filename))
+
+    if key not in _loaded:
+        with open(filename, "rb") as f:
+            index = pickle.load(f)
+
+        index.filename = filename
+
+        _loaded.clear()
+        _loaded[key] = index
+
+    return _loaded[key]
+
+
+class BruteForceSearch:
+    """Exact neighbour search by calculating all distances.
+
+    Squared distances are calculated as ``|x|^2 + |y|^2 - 2 <x, y>``,
+    which turns the bulk of the work into a matrix product for blocks
+    of query points. The block size is chosen such that the matrices of
+    each block do not exceed a memory budget. Since this formula is
+    prone to rounding errors, it is only used to select candidates,
+    whose exact distances are calculated afterwards.
+
+    This class mirrors the query interface of the trees of `sklearn`.
+    """
+
+    def __init__(self, X, max_memory=2**28):
+        """Initialise new search.
+
+        Parameters
+        ----------
+        X : np.array of shape ``(N, d)``
+            Input data set.
+
+        max_memory : int
+            Memory budget in bytes for the distance matrices of each
+            block of query points.
+        """
+        self.data = np.asarray(X)
+        self.max_memory = max_memory
+
+        self.norms = np.einsum("ij,ij->i", self.data, self.data, dtype=float)
+
+    def _blocks(self, Y):
+        # Every block requires about three matrices of shape `(n, N)`,
+        # i.e. the matrix product, the squared distances, and a mask.
+        n_bytes = 3 * 8 * max(len(self.data), 1)
+        block_size = max(1, self.max_memory // n_bytes)
+
+        max_norm = np.max(self.norms, initial=0.0)
+
+        for start in range(0, len(Y), block_size):
+            block = Y[start : start + block_size]
+            norms = np.einsum("ij,ij->i", block, block)
+
+            D = block @ self.data.T
+            D *= -2
+            D += norms[:, None]
+            D += self.norms[None, :]
+
+            # Bound on the rounding error of squared distances; anything
+            # within this bound is a candidate.
+            slack = 1e-8 * (norms + max_norm)
+
+            yield start, block, D, slack
+
+    def _distances(self, y, candidates):
+        return np.linalg.norm(self.data[candidates] - y, axis=1)
+
+    def query(self, Y, k, return_distance=True):
+        Y = np.asarray(Y, dtype=float)
+
+        distances = np.empty((len(Y), k))
+        indices = np.empty((len(Y), k), dtype=int)
+
+        for start, block, D, slack in self._blocks(Y):
+            kth = np.partition(D, k - 1, axis=1)[:, k - 1]
+
+            for i, (y, row) in enumerate(zip(block, D)):
+                candidates = np.flatnonzero(row <= kth[i] + slack[i])
+                exact = self._distances(y, candidates)
+
+                order = np.argsort(exact, kind="stable")[:k]
+
+                indices[start + i] = candidates[order]
+                distances[start + i] = exact[order]
+
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+    def query_radius(self, Y, r, return_distance=True, sort_results=True):
+        Y = np.asarray(Y, dtype=float)
+        r = np.full(len(Y), r, dtype=float)
+
+        indices = np.empty(len(Y), dtype=object)
+        distances = np.empty(len(Y), dtype=object)
+
+        for start, block, D, slack in self._blocks(Y):
+            for i, (y, row) in enumerate(zip(block, D)):
+                radius = r[start + i]
+
+                candidates = np.flatnonzero(row <= radius**2 + slack[i])
+                exact = self._distances(y, candidates)
+
+                mask = exact <= radius
+                candidates, exact = candidates[mask], exact[mask]
+
+                if sort_results:
+                    order = np.argsort(exact, kind="stable")
+                    candidates, exact = candidates[order], exact[order]
+
+                indices[start + i] = candidates
+                distances[start + i] = exact
+
+        if return_distance:
+            return indices, distances
+        else:
+            return indices
+
+
+class _RandomProjectionForest:
+    """Approximate neighbour search with random projection trees.
+
+    Every tree recursively splits the data set at the median of its
+    projection onto a random direction until each leaf contains at most
+    `leaf_size` points. The candidates for the neighbours of a query
+    point are all points that share a leaf with it in any tree; only
+    their distances are calculated. This class mirrors the query
+    interface of the trees of `sklearn`.
+    """
+
+    def __init__(self, X, leaf_size=40, n_trees=10, seed=0):
+        self.data = np.asarray(X)
+        self.leaf_size = max(leaf_size, 1)
+
+        rng = np.random.default_rng(seed)
+        self.trees = [self._build(rng) for _ in range(n_trees)]
+
+    def _build(self, rng):
+        # Trees are stored as flat arrays of nodes. Inner nodes have
+        # a splitting direction and threshold, while leaves refer to
+        # a contiguous range of the permutation of the data set.
+        directions = []
+        thresholds = []
+        children = []
+        ranges = []
+
+        permutation = np.arange(len(self.data))
+        stack = [(0, len(self.data))]
+
+        def add_node():
+            directions.append(None)
+            thresholds.append(0.0)
+            children.append((-1, -1))
+            ranges.append((0, 0))
+            return len(directions) - 1
+
+        nodes = [add_node()]
+
+        while stack:
+            start, end = stack.pop()
+            node = nodes.pop()
+
+            if end - start <= self.leaf_size:
+                ranges[node] = (start, end)
+                continue
+
+            indices = permutation[start:end]
+
+            direction = rng.standard_normal(self.data.shape[1])
+            projection = self.data[indices] @ direction
+
+            order = np.argsort(projection, kind="stable")
+            middle = (end - start) // 2
+
+            permutation[start:end] = indices[order]
+
+            directions[node] = direction
+            thresholds[node] = projection[order[middle]]
+
+            left, right = add_node(), add_node()
+            children[node] = (left, right)
+
+            stack.extend([(start, start + middle), (start + middle, end)])
+            nodes.extend([left, right])
+
+        # Leaves do not have a direction; we store zeros instead so that
+        # all directions form a single matrix.
+        zeros = np.zeros(self.data.shape[1])
+
+        return {
+            "directions": np.asarray(
+                [zeros if d is None else d for d in directions]
+            ),
+            "thresholds": np.asarray(thresholds),
+            "children": np.asarray(children),
+            "ranges": np.asarray(ranges),
+            "permutation": permutation,
+        }
+
+    def _leaves(self, tree, Y):
+        # Descend all query points at once, one level at a time.
+        nodes = np.zeros(len(Y), dtype=int)
+        active = tree["children"][nodes, 0] >= 0
+
+        while np.any(active):
+            current = nodes[active]
+
+            projection = np.einsum(
+                "ij,ij->i", Y[active], tree["directions"][current]
+            )
+
+            right = projection >= tree["thresholds"][current]
+            nodes[active] = tree["children"][current, right.astype(int)]
+
+            active = tree["children"][nodes, 0] >= 0
+
+        return nodes
+
+    def _candidates(self, Y):
+        leaves = [self._leaves(tree, Y) for tree in self.trees]
+
+        for i in range(len(Y)):
+            candidates = [
+                tree["permutation"][slice(*tree["ranges"][nodes[i]])]
+                for tree, nodes in zip(self.trees, leaves)
+            ]
+
+            candidates = np.unique(np.concatenate(candidates))
+            yield candidates, np.linalg.norm(
+                self.data[candidates] - Y[i], axis=1
+            )
+
+    def query(self, Y, k, return_distance=True):
+        Y = np.asarray(Y, dtype=float)
+
+        distances = np.empty((len(Y), k))
+        indices = np.empty((len(Y), k), dtype=int)
+
+        # Query points with fewer than `k` candidates; their neighbours
+        # are determined by exact search instead.
+        missing = []
+
+        for i, (candidates, D) in enumerate(self._candidates(Y)):
+            if len(candidates) < k:
+                missing.append(i)
+                continue
+
+            order = np.argsort(D, kind="stable")[:k]
+
+            distances[i] = D[order]
+            indices[i] = candidates[order]
+
+        if missing:
+            distances[missing], indices[missing] = BruteForceSearch(
+                self.data
+            ).query(Y[missing], k)
+
+        if return_distance:
+            return distances, indices
+        else:
+            return indices
+
+    def query_radius(self, Y, r, return_distance=True, sort_results=True):
+        Y = np.asarray(Y, dtype=float)
+        r = np.full(len(Y), r, dtype=float)
+
+        indices = np.empty(len(Y), dtype=object)
+        distances = np.empty(len(Y), dtype=object)
+
+        for i, (candidates, D) in enumerate(self._candidates(Y)):
+            mask = D <= r[i]
+            candidates, D = candidates[mask], D[mask]
+
+            if sort_results:
+                order = np.argsort(D, kind="stable")
+                candidates, D = candidates[order], D[order]
+
+            indices[i] = candidates
+            distances[i] = D
+
+        if return_distance:
+            return indices, distances
+        else:
+            return indices
@@ -0,0 +1,186 @@
+"""Output handling for Euclidicity calculations.
+
+This module provides a streaming writer for the results of Euclidicity
+calculations. Results are written chunk by chunk as they become ready,
+making it possible to resume interrupted calculations.
+"""
+
+import os
+import shutil
+import sys
+
+import numpy as np
+import pandas as pd
+
+from tardis.filesystem import atomic_write
+
+
+class ResultWriter:
+    """Streaming writer for Euclidicity results.
+
+    Text formats (CSV and TSV) are appended to directly. Binary formats
+    (NPY and NPZ) cannot be appended to, so every chunk is stored as
+    a shard in a folder next to the output file instead. The shards are
+    combined into the output file once all chunks have been written.
+    """
+
+    def __init__(self, filename=None, resume=False):
+        """Initialise new writer.
+
+        Parameters
+        ----------
+        filename : str or None
+            Output file. The output format is guessed from its
+            extension. If not set, results are written to standard
+            output in CSV format.
+
+        resume : bool
+            If set, keeps all results that are already present in the
+            output file, and appends new results to them. Else, any
+            existing output is discarded.
+        """
+        self.filename = filename
+
+        if filename is None:
+            if resume:
+                raise RuntimeError("Resuming requires an output file.")
+
+            self.extension = ".csv"
+        else:
+            self.extension = os.path.splitext(filename)[1]
+
+        if self.extension not in [".csv", ".tsv", ".npy", ".npz"]:
+            raise RuntimeError(f"Unsupported output format {self.extension}")
+
+        self.sep = "\t" if self.extension == ".tsv" else ","
+        self.shards = f"{filename}.parts"
+
+        if resume:
+            self._prepare_resume()
+        else:
+            self._clear()
+
+        self.n_rows = len(self.read())
+
+    def read(self):
+        """Read all results that have been written so far.
+
+        Returns
+        -------
+        np.array
+            Array of all rows that have been written, in order.
+        """
+        if self.filename is None:
+            return np.empty((0, 0))
+
+        if self._is_binary():
+            # Ignore temporary files of shards that are being written.
+            filenames = sorted(
+                f for f in os.listdir(self.shards) if f.endswith(".npy")
+            )
+            arrays = [np.load(os.path.join(self.shards, f)) for f in filenames]
+
+            return np.row_stack(arrays) if arrays else np.empty((0, 0))
+
+        if not os.path.exists(self.filename):
+            return np.empty((0, 0))
+
+        try:
+            return pd.read_csv(self.filename, sep=self.sep).to_numpy()
+        except pd.errors.EmptyDataError:
+            return np.empty((0, 0))
+
+    def write(self, df):
+        """Append chunk of results.
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Results to append. All chunks must have the same columns.
+        """
+        if self._is_binary():
+            _save(
+                os.path.join(self.shards, f"{self.n_rows:012d}.npy"),
+                df.to_numpy(),
+            )
+        else:
+            # Only write a header to empty files. A resumed file may be
+            # empty apart from its header.
+            if self.filename is None or not os.path.exists(self.filename):
+                header = self.n_rows == 0
+            else:
+                header = os.path.getsize(self.filename) == 0
+
+            text = df.to_csv(index=False, header=header, sep=self.sep)
+
+            if self.filename is None:
+                sys.stdout.write(text)
+                sys.stdout.flush()
+            else:
+                # Flush the chunk to disk right away so that it survives
+                # an interruption of the calculation.
+                with open(self.filename, "a") as f:
+                    f.write(text)
+                    f.flush()
+                    os.fsync(f.fileno())
+
+        self.n_rows += len(df)
+
+    def close(self):
+        """Finalise output by combining all shards if necessary."""
+        if not self._is_binary():
+            return
+
+        X = self.read()
+
+        if self.extension == ".npy":
+            _save(self.filename, X)
+        elif self.extension == ".npz":
+            _save(self.filename, X, npz=True)
+
+        shutil.rmtree(self.shards)
+
+    def _is_binary(self):
+        return self.extension in [".npy", ".npz"]
+
+    def _clear(self):
+        if self.filename is None:
+            return
+
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+        if self._is_binary():
+            shutil.rmtree(self.shards, ignore_errors=True)
+            os.makedirs(self.shards)
+
+    def _prepare_resume(self):
+        if self._is_binary():
+            # The output of a finished calculation becomes the first
+            # shard of the resumed calculation.
+            if not os.path.exists(self.shards):
+                os.makedirs(self.shards)
+
+                if os.path.exists(self.filename):
+                    if self.extension == ".npy":
+                        X = np.load(self.filename)
+                    else:
+                        X = np.load(self.filename)["arr_0"]
+
+                    _save(os.path.join(self.shards, f"{0:012d}.npy"), X)
+
+        elif os.path.exists(self.filename):
+            # Remove an incomplete last line, which may be the result of
+            # an interruption while writing.
+            with open(self.filename, "rb+") as f:
+                content = f.read()
+                f.truncate(content.rfind(b"\n") + 1)
+
+
+def _save(filename, X, npz=False):
+    # An interruption must never leave an incomplete file behind.
+    with atomic_write(filename) as f:
+        if npz:
+            np.savez(f, X)
+        else:
+            np.save(f, X)
@@ -0,0 +1,262 @@
+"""Parallel execution of Euclidicity calculations.
+
+This module distributes Euclidicity calculations over multiple workers.
+To avoid serialising the full data set for every task, the data set is
+placed in a memory-mapped file that all workers share. Each worker sets
+up its Euclidicity functor, including the index for radius queries, only
+once, so that tasks merely carry the indices of their query points.
+"""
+
+import contextlib
+import copy
+import os
+import tempfile
+import threading
+
+import joblib
+
+import numpy as np
+
+from threadpoolctl import threadpool_limits
+
+from tardis.euclidicity import Euclidicity
+from tardis.profiling import Profiler
+
+# Execution backends and their corresponding `joblib` backends. Threads
+# are only useful if the persistent homology calculations release the
+# GIL, but they avoid any data transfer.
+BACKENDS = {
+    "processes": "loky",
+    "threads": "threading",
+    "sequential": "sequential",
+}
+
+# Functor of the current worker, together with the key of the data set
+# and parameters it has been set up for. Workers are reused between the
+# tasks of a run, so we only need to keep track of the last functor.
+# With the threading backend, this state is shared by all threads.
+_worker_state = {}
+_worker_lock = threading.Lock()
+
+
+def share_array(X, folder):
+    """Store array in a memory-mapped file.
+
+    Parameters
+    ----------
+    X : np.array
+        Input array.
+
+    folder : str
+        Folder for storing the memory-mapped file. The folder must
+        exist for as long as the array is being used.
+
+    Returns
+    -------
+    np.memmap
+        Read-only memory-mapped view of the array. When being passed to
+        `joblib` workers, only a reference to the file is transferred.
+    """
+    fd, filename = tempfile.mkstemp(suffix=".npy", dir=folder)
+    os.close(fd)
+
+    np.save(filename, np.asarray(X))
+    return np.load(filename, mmap_mode="r")
+
+
+def split_threads(n_cores, n_threads):
+    """Split a budget of cores into parallel jobs and threads per job.
+
+    Parameters
+    ----------
+    n_cores : int
+        Total number of cores, following the conventions of `joblib`
+        for the number of jobs, i.e. -1 refers to all cores.
+
+    n_threads : int
+        Number of threads per job, used for persistent homology
+        calculations and linear algebra routines.
+
+    Returns
+    -------
+    Tuple of int, int
+        Number of parallel jobs and number of threads per job. Their
+        product does not exceed the budget of cores.
+    """
+    n_cores = joblib.effective_n_jobs(n_cores)
+    n_threads = max(min(n_threads, n_cores), 1)
+
+    return n_cores // n_threads, n_threads
+
+
+def iter_score_blocks(
+    X,
+    query_points,
+    blocks,
+    scales,
+    params,
+    n_jobs=1,
+    backend="processes",
+    n_threads=1,
+    profile=False,
+    index=None,
+):
+    """Calculate Euclidicity for blocks of query points, one by one.
+
+    Blocks are processed in parallel, in rounds of a few blocks per job,
+    and their results are yielded in order as soon as a round finishes.
+    This permits processing results while the calculation is ongoing.
+
+    Parameters
+    ----------
+    X : np.array of shape ``(N, d)``
+        Input data set.
+
+    query_points : np.array of shape ``(M, d)``
+        Query points. May be the same array as `X`.
+
+    blocks : list of np.array
+        Indices of the query points that form a single task, as, for
+        instance, returned by :func:`tardis.api.split_query_points`.
+
+    scales : np.array of shape ``(M, 4)`` or None
+        Per-point scales, as returned by
+        :func:`tardis.utils.estimate_scales`. If not set, scales will be
+        taken from `params`.
+
+    params : dict
+        Keyword arguments for setting up the :class:`Euclidicity`
+        functor. The data set must not be part of this.
+
+    n_jobs : int
+        Number of parallel jobs, following the conventions of `joblib`.
+
+    backend : str
+        Execution backend. Must be one of "processes", "threads", or
+        "sequential". Only the "processes" backend requires sharing the
+        data set via memory-mapped files.
+
+    n_threads : int
+        Number of threads per job. This is used for persistent homology
+        calculations and as a limit for linear algebra routines within
+        each job, thus preventing oversubscription of cores. Use
+        :func:`split_threads` to distribute a budget of cores.
+
+    profile : bool
+        If set, profile the calculations of every block. See
+        :class:`tardis.profiling.Profiler` for details.
+
+    index : :class:`tardis.neighbours.NeighbourIndex` or None
+        If set, use this index of `X` for radius queries instead of
+        building a new one in every worker.
+
+    Yields
+    ------
+    Tuple of np.array, np.array
+        Output of :meth:`Euclidicity.score_many` for each block. If
+        `profile` is set, the profiling records of the query points of
+        the block are yielded as a third element.
+    """
+    if backend not in BACKENDS:
+        raise RuntimeError(f"Unknown execution backend {backend}.")
+
+    if backend == "sequential":
+        n_jobs = 1
+
+    with tempfile.TemporaryDirectory() as folder:
+        if backend == "processes" and joblib.effective_n_jobs(n_jobs) > 1:
+            shared_query_points = query_points is X
+
+            X = share_array(X, folder)
+
+            if shared_query_points:
+                query_points = X
+            else:
+                query_points = share_array(query_points, folder)
+
+            # Indices that are stored on disk are only passed to workers
+            # by reference to their file.
+            if index is not None and index.filename is None:
+                index = copy.copy(index)
+                index.save(os.path.join(folder, "index.pkl"))
+
+        # Thread pools of linear algebra routines are limited once per
+        # run: on startup of every worker process, or else for this
+        # process, since it runs all blocks. Limits are process-wide, so
+        # they must not be changed by concurrent blocks.
+        if backend == "processes" and joblib.effective_n_jobs(n_jobs) > 1:
+            limits = contextlib.nullcontext()
+            inner_max_num_threads = n_threads
+        else:
+            limits = threadpool_limits(limits=n_threads)
+            inner_max_num_threads = None
+
+        with limits, joblib.parallel_backend(
+            BACKENDS[backend], inner_max_num_threads=inner_max_num_threads
+        ), joblib.Parallel(n_jobs=n_jobs) as parallel:
+            round_size = 2 * joblib.effective_n_jobs(n_jobs)
+
+            for start in range(0, len(blocks), round_size):
+                yield from parallel(
+                    joblib.delayed(_process_block)(
+                        X,
+                        query_points,
+                        indices,
+                        None if scales is None else scales[indices],
+                        dict(params, n_threads=n_threads),
+                        profile,
+                        index,
+                    )
+                    for indices in blocks[start : start + round_size]
+                )
+
+
+def score_blocks(*args, **kwargs):
+    """Calculate Euclidicity for blocks of query points in parallel.
+
+    This function takes the same arguments as :func:`iter_score_blocks`
+    but only returns once all blocks have been processed.
+
+    Returns
+    -------
+    List of tuples of np.array, np.array
+        Output of :meth:`Euclidicity.score_many` for each block.
+    """
+    return list(iter_score_blocks(*args, **kwargs))
+
+
+def _get_euclidicity(X, params, index):
+    # Memory-mapped arrays and stored indices are identified by their
+    # file, thus ensuring that the functor is only set up once per
+    # worker.
+    key = (
+        getattr(X, "filename", None) or id(X),
+        joblib.hash(params),
+        None if index is None else index.filename or id(index),
+    )
+
+    with _worker_lock:
+        if _worker_state.get("key") != key:
+            _worker_state["euclidicity"] = Euclidicity(
+                data=X if index is None else index, **params
+            )
+            _worker_state["key"] = key
+
+        return _worker_state["euclidicity"]
+
+
+def _process_block(X, query_points, indices, scales, params, profile, index):
+    euclidicity = _get_euclidicity(X, params, index)
+
+    # Every block gets its own profiler, since the functor may be shared
+    # by multiple threads.
+    profiler = Profiler() if profile else None
+
+    scores, dimensions = euclidicity.score_many(
+        X, query_points[indices], scales=scales, profiler=profiler
+    )
+
+    if profile:
+        return scores, dimensions, profiler.records
+    else:
+        return scores, dimensions
@@ -6,85 +6,389 @@ barcodes etc. are always consistent regardless of any implementation
 details.
 """
 
+import functools
+import threading
+
 import gudhi as gd
 import numpy as np
 
 from gph import ripser_parallel
 
+# The first calls to `ripser_parallel` in a process deadlock when they
+# are made concurrently from multiple threads, since the bindings import
+# modules lazily while converting the results. Once a call has finished,
+# further calls can run concurrently, so we only serialise the first one.
+_ripser_lock = threading.Lock()
+_ripser_ready = threading.Event()
+
+
+class PersistenceDiagram:
+    """Persistence diagram with features grouped by dimension.
+
+    All features are stored in a single contiguous array, sorted by
+    dimension, with offsets marking the features of each dimension. The
+    diagram can be used wherever an array is expected, in which case
+    it behaves like the stacked diagram of all dimensions.
+    """
+
+    def __init__(self, points, offsets):
+        """Initialise new persistence diagram.
+
+        Parameters
+        ----------
+        points : np.array of shape ``(n, 2)``
+            Features of all dimensions, sorted by dimension.
+
+        offsets : np.array of shape ``(n_dims + 1, )``
+            Offsets of the features of each dimension, such that the
+            features of dimension `d` are stored in the rows between
+            ``offsets[d]`` and ``offsets[d + 1]``.
+        """
+        self.points = np.asarray(points, dtype=float).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=int)
+
+    @classmethod
+    def from_diagrams(cls, diagrams):
+        """Create persistence diagram from diagrams per dimension.
+
+        Parameters
+        ----------
+        diagrams : list of array_like of shape ``(n, 2)``
+            Features of each dimension, in order of dimension.
+
+        Returns
+        -------
+        PersistenceDiagram
+            Combined persistence diagram.
+        """
+        diagrams = [
+            np.asarray(D, dtype=float).reshape(-1, 2) for D in diagrams
+        ]
+        offsets = np.cumsum([0] + [len(D) for D in diagrams])
+
+        if diagrams:
+            return cls(np.concatenate(diagrams), offsets)
+        else:
+            return cls(np.empty((0, 2)), offsets)
+
+    @property
+    def n_dims(self):
+        """Return number of dimensions."""
+        return len(self.offsets) - 1
+
+    def __getitem__(self, dim):
+        """Return features of the given dimension."""
+        if dim >= self.n_dims:
+            return np.empty((0, 2))
+
+        return self.points[self.offsets[dim] : self.offsets[dim + 1]]
+
+    def __len__(self):
+        """Return number of features over all dimensions."""
+        return len(self.points)
+
+    def __array__(self, dtype=None, copy=None):
+        """Return features over all dimensions as a stacked array."""
+        return np.asarray(self.points, dtype=dtype)
+
+    def __mul__(self, factor):
+        """Return persistence diagram with scaled features."""
+        return PersistenceDiagram(self.points * factor, self.offsets)
+
+
+def bottleneck_distances(diagrams1, diagrams2, error=None):
+    """Calculate Bottleneck distances between pairs of diagrams.
+
+    Essential features, i.e. points with infinite death, are matched
+    directly, since they can only be matched to each other. Likewise,
+    distances to empty diagrams, or to diagrams with a single finite
+    feature, such as those of fixed annuli, are evaluated in closed
+    form. Only the remaining pairs require a general matching.
+
+    Pairs are still evaluated one by one; the speed-up over calculating
+    a general matching for every pair stems from these closed forms,
+    not from vectorising the calculation over pairs.
+
+    Parameters
+    ----------
+    diagrams1 : iterable of np.array of shape ``(n, 2)``
+        First persistence diagram of each pair.
+
+    diagrams2 : iterable of np.array of shape ``(n, 2)``
+        Second persistence diagram of each pair.
+
+    error : float or None
+        If set, calculate approximate Bottleneck distances, which differ
+        from the exact distances by at most this value. Else, calculate
+        exact distances.
+
+    Returns
+    -------
+    np.array
+        Bottleneck distance of each pair.
+    """
+    return np.asarray(
+        [
+            _bottleneck_distance(D1, D2, error)
+            for D1, D2 in zip(diagrams1, diagrams2)
+        ],
+        dtype=float,
+    )
+
+
+def bottleneck_distances_per_dimension(diagrams1, diagrams2, error=None):
+    """Calculate Bottleneck distances between pairs of diagrams.
+
+    In contrast to :func:`bottleneck_distances`, features are only
+    matched within the same dimension. The distance of a pair is the
+    maximum distance over all dimensions.
+
+    Parameters
+    ----------
+    diagrams1 : iterable of PersistenceDiagram
+        First persistence diagram of each pair.
+
+    diagrams2 : iterable of PersistenceDiagram
+        Second persistence diagram of each pair.
+
+    error : float or None
+        If set, calculate approximate Bottleneck distances. See
+        :func:`bottleneck_distances` for details.
+
+    Returns
+    -------
+    np.array
+        Bottleneck distance of each pair.
+    """
+    output = []
+
+    for D1, D2 in zip(diagrams1, diagrams2):
+        dist = 0.0
+
+        for dim in range(max(D1.n_dims, D2.n_dims)):
+            dist = max(dist, _bottleneck_distance(D1[dim], D2[dim], error))
+
+            # No other dimension can increase the distance any further.
+            if np.isinf(dist):
+                break
+
+        output.append(dist)
+
+    return np.asarray(output, dtype=float)
+
+
+def _bottleneck_distance(D1, D2, error):
+    D1 = np.asarray(D1, dtype=float).reshape(-1, 2)
+    D2 = np.asarray(D2, dtype=float).reshape(-1, 2)
+
+    essential1 = np.isinf(D1[:, 1])
+    essential2 = np.isinf(D2[:, 1])
+
+    # Essential features cannot be matched to the diagonal, so diagrams
+    # with different numbers of them are infinitely far apart. Else, it
+    # is optimal to match them in order of their births.
+    if essential1.sum() != essential2.sum():
+        return np.inf
+
+    dist = np.max(
+        np.abs(np.sort(D1[essential1, 0]) - np.sort(D2[essential2, 0])),
+        initial=0.0,
+    )
+
+    D1 = D1[~essential1]
+    D2 = D2[~essential2]
+
+    # If one of the diagrams is empty, all features of the other one are
+    # matched to the diagonal.
+    if len(D1) == 0 or len(D2) == 0:
+        D = D1 if len(D2) == 0 else D2
+        return max(dist, np.max(D[:, 1] - D[:, 0], initial=0.0) / 2)
+
+    # Diagrams of fixed annuli only contain a single finite feature, for
+    # which the optimal matching is known in closed form.
+    if len(D1) == 1 or len(D2) == 1:
+        D, (birth, death) = (D2, D1[0]) if len(D1) == 1 else (D1, D2[0])
+        return max(dist, _single_point_distance(D, birth, death))
+
+    return max(dist, gd.bottleneck_distance(D1, D2, error))
+
+
+def _single_point_distance(D, birth, death):
+    # Bottleneck distance between a diagram of finite features and the
+    # diagram consisting of a single point. Either the point is matched
+    # to the diagonal, together with all other features, or it is matched
+    # to one of the features, while all remaining ones are matched to
+    # the diagonal. Only the two most persistent features are relevant
+    # for the cost of the remaining features.
+    persistence = (D[:, 1] - D[:, 0]) / 2
+    order = np.argsort(persistence)[::-1]
+
+    highest = persistence[order[0]]
+    second_highest = persistence[order[1]] if len(D) > 1 else 0.0
+
+    remaining = np.full(len(D), highest)
+    remaining[order[0]] = second_highest
+
+    costs = np.maximum(
+        np.maximum(np.abs(D[:, 0] - birth), np.abs(D[:, 1] - death)),
+        remaining,
+    )
+
+    return min(max(highest, (death - birth) / 2), np.min(costs))
+
 
 class GUDHI:
     """Wrapper for GUDHI persistent homology calculations."""
 
-    def __call__(self, X, max_dim):
+    def __init__(self, sparse=None, error=None, stack_diagrams=True):
+        """Initialise new wrapper.
+
+        Parameters
+        ----------
+        sparse : float or None
+            If set, use a sparse Rips complex with this approximation
+            parameter. The resulting persistence diagram is guaranteed
+            to be a multiplicative ``(1 + sparse)``-approximation of the
+            exact diagram, while the complex is substantially smaller.
+
+        error : float or None
+            If set, calculate approximate Bottleneck distances with this
+            additive error. See :func:`bottleneck_distances`.
+
+        stack_diagrams : bool
+            If set, features of all dimensions are matched jointly when
+            calculating Bottleneck distances. Else, features are only
+            matched within the same dimension; see
+            :func:`bottleneck_distances_per_dimension`.
+        """
+        self.sparse = sparse
+        self.error = error
+        self.stack_diagrams = stack_diagrams
+
+    def __call__(self, X, max_dim, metric="euclidean", threshold=np.inf):
         """Calculate persistent homology.
 
         Parameters
         ----------
-        X : np.array of shape ``(N, d)``
-            Input data set.
+        X : np.array of shape ``(N, d)`` or ``(N, N)``
+            Input data set or, if `metric` is "precomputed", its matrix
+            of pairwise distances.
 
         max_dim : int
             Maximum dimension for calculations
 
+        metric : str
+            Either "euclidean" for point clouds or "precomputed" for
+            distance matrices.
+
+        threshold : float
+            Maximum edge length of the Rips complex. Features appearing
+            at larger scales are not being calculated, and features that
+            are still alive at this scale are considered to be infinite.
+
         Returns
         -------
-        np.array
-            Full barcode (persistence diagram) of the data set.
+        Tuple of PersistenceDiagram, int
+            Persistence diagram of the data set and the maximum dimension
+            with features. If there are no features, returns `None` and
+            -1 instead.
         """
-        barcodes = (
-            gd.RipsComplex(points=X)
-            .create_simplex_tree(max_dimension=max_dim)
-            .persistence()
-        )
+        if metric == "precomputed":
+            rips_complex = gd.RipsComplex(
+                distance_matrix=X,
+                max_edge_length=threshold,
+                sparse=self.sparse,
+            )
+        else:
+            rips_complex = gd.RipsComplex(
+                points=X,
+                max_edge_length=threshold,
+                sparse=self.sparse,
+            )
+
+        simplex_tree = rips_complex.create_simplex_tree(max_dimension=max_dim)
+        simplex_tree.compute_persistence()
+
+        # Intervals are already available as arrays per dimension, so we
+        # do not need to convert them from a list of tuples.
+        diagrams = [
+            simplex_tree.persistence_intervals_in_dimension(d)
+            for d in range(simplex_tree.dimension() + 1)
+        ]
+
+        dims = [d for d, D in enumerate(diagrams) if len(D) > 0]
 
-        if len(barcodes) == 0:
+        if len(dims) == 0:
             return None, -1
 
         # TODO: Check whether this is *always* a feature of non-zero
         # persistence.
-        max_dim = np.max([d for d, _ in barcodes])
+        max_dim = dims[-1]
 
-        # TODO: We are throwing away dimensionality information; it is
-        # thus possible that we are matching across different dimensions
-        # in any distance calculation.
-        barcodes = np.asarray([np.array(x) for _, x in barcodes])
+        # Diagrams of all dimensions are kept separately, so whether
+        # features are matched across dimensions is only decided when
+        # calculating distances.
+        barcodes = PersistenceDiagram.from_diagrams(diagrams[: max_dim + 1])
 
         return barcodes, max_dim
 
     def distance(self, D1, D2):
         """Calculate Bottleneck distance between two persistence diagrams."""
-        return gd.bottleneck_distance(D1, D2)
+        return self.distances([D1], [D2])[0]
+
+    def distances(self, diagrams1, diagrams2):
+        """Calculate Bottleneck distances between pairs of diagrams."""
+        if self.stack_diagrams:
+            return bottleneck_distances(diagrams1, diagrams2, self.error)
+
+        return bottleneck_distances_per_dimension(
+            diagrams1, diagrams2, self.error
+        )
 
 
 class Ripser:
-    def __init__(self, stack_diagrams=True):
+    def __init__(self, stack_diagrams=True, n_threads=1, error=None):
         self.stack_diagrams = stack_diagrams
+        self.n_threads = n_threads
+        self.error = error
 
         if self.stack_diagrams:
-            def distance_fn(D1, D2):
-                return gd.bottleneck_distance(D1, D2)
+            def distances_fn(diagrams1, diagrams2):
+                return bottleneck_distances(diagrams1, diagrams2, error)
         else:
-            def distance_fn(diagrams1, diagrams2):
-                values = [
-                    gd.bottleneck_distance(D1, D2)
-                    for D1, D2 in zip(diagrams1, diagrams2)
-                ]
-                return np.max(values)
+            def distances_fn(diagrams1, diagrams2):
+                return bottleneck_distances_per_dimension(
+                    diagrams1, diagrams2, error
+                )
 
-        self.distance = distance_fn
+        self.distances = distances_fn
 
-    def __call__(self, X, max_dim):
+    def distance(self, D1, D2):
+        """Calculate Bottleneck distance between two persistence diagrams."""
+        return self.distances([D1], [D2])[0]
+
+    def __call__(self, X, max_dim, metric="euclidean", threshold=np.inf):
         if len(X) == 0:
             return [], -1
 
-        diagrams = ripser_parallel(
-            X, maxdim=max_dim, collapse_edges=True
+        ripser_fn = functools.partial(
+            ripser_parallel,
+            X,
+            maxdim=max_dim,
+            metric=metric,
+            thresh=threshold,
+            collapse_edges=True,
+            n_threads=self.n_threads,
         )
 
+        if _ripser_ready.is_set():
+            diagrams = ripser_fn()
+        else:
+            with _ripser_lock:
+                diagrams = ripser_fn()
+                _ripser_ready.set()
+
         diagrams = diagrams["dgms"]
         max_dim = np.max([d for d, D in enumerate(diagrams) if len(D) > 0])
 
-        if self.stack_diagrams:
-            diagrams = np.row_stack(diagrams)
-
-        return diagrams, max_dim
+        return PersistenceDiagram.from_diagrams(diagrams), max_dim
@@ -0,0 +1,152 @@
+"""Profiling of Euclidicity calculations.
+
+This module provides a profiler that collects timings of the individual
+stages of Euclidicity calculations, together with counters such as the
+sizes of annuli, for every query point. This makes it possible to find
+out where time is spent and to choose parameters accordingly.
+"""
+
+import contextlib
+import time
+
+import numpy as np
+
+# Stages of a Euclidicity calculation, in order of execution.
+STAGES = [
+    "neighbour_search",
+    "annulus_extraction",
+    "data_ph",
+    "model_sampling",
+    "model_ph",
+    "distance",
+]
+
+
+class Profiler:
+    """Collect timings and counters of Euclidicity calculations.
+
+    The profiler keeps one record per query point. Every record maps the
+    names of stages to the time spent in them, in seconds, and the names
+    of counters to their values.
+    """
+
+    def __init__(self):
+        """Initialise new profiler without any records."""
+        self.records = []
+
+    def begin(self):
+        """Begin a new record for the next query point."""
+        self.records.append({})
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Measure the time spent in a stage of the calculation.
+
+        Parameters
+        ----------
+        name : str
+            Name of the stage. Repeated measurements of the same stage
+            are added up.
+        """
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, value=1):
+        """Add value to a timing or counter of the current record.
+
+        Parameters
+        ----------
+        name : str
+            Name of the timing or counter
+
+        value : float
+            Value to add
+        """
+        record = self.records[-1]
+        record[name] = record.get(name, 0) + value
+
+    def maximum(self, name, value):
+        """Update maximum of a counter of the current record.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter
+
+        value : float
+            Value to compare with
+        """
+        record = self.records[-1]
+        record[name] = max(record.get(name, value), value)
+
+
+class NullProfiler:
+    """Profiler that does not collect anything.
+
+    This class provides the same interface as :class:`Profiler`, making
+    it possible to profile calculations without checking whether
+    profiling is enabled.
+    """
+
+    def begin(self):
+        pass
+
+    def stage(self, name):
+        return contextlib.nullcontext()
+
+    def add(self, name, value=1):
+        pass
+
+    def maximum(self, name, value):
+        pass
+
+
+def summarise(records):
+    """Summarise profiling records.
+
+    Parameters
+    ----------
+    records : list of dict
+        Profiling records, as collected by :class:`Profiler`.
+
+    Returns
+    -------
+    dict
+        Total time spent in every stage and its share of the total time
+        of all stages, totals of all counters, and the mean and maximum
+        size of annuli.
+    """
+    summary = {"n_points": len(records)}
+
+    total = sum(
+        record.get(stage, 0.0) for record in records for stage in STAGES
+    )
+
+    for stage in STAGES:
+        time_spent = sum(record.get(stage, 0.0) for record in records)
+
+        summary[f"{stage}_time"] = time_spent
+        summary[f"{stage}_share"] = time_spent / total if total > 0 else 0.0
+
+    counters = sorted(
+        {name for record in records for name in record} - set(STAGES)
+    )
+
+    for name in counters:
+        values = [record.get(name, 0) for record in records]
+
+        if name.startswith("max_"):
+            summary[name] = np.max(values)
+        else:
+            summary[name] = np.sum(values)
+
+    if summary.get("n_annuli", 0) > 0:
+        summary["mean_annulus_size"] = (
+            summary["annulus_size"] / summary["n_annuli"]
+        )
+
+    return summary
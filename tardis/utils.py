@@ -4,19 +4,24 @@ This module collects some utility functions, making them accessible to
 a wider number of modules.
 """
 
+import gzip
 import logging
 import os
+import warnings
 
 import numpy as np
 
-from sklearn.neighbors import KDTree
-
 from tardis.data import sample_vision_data_set
+from tardis.neighbours import NeighbourIndex
 
 
 def load_data(filename, batch_size, n_query_points, seed=None):
     """Load data from filename, depending on input type.
 
+    Only the sampled points of a file are kept in memory. Arrays stored
+    in ``.npy`` files are memory-mapped, while text files, optionally
+    compressed with ``gzip``, are read in chunks.
+
     Parameters
     ----------
     filename : str
@@ -42,10 +47,28 @@ def load_data(filename, batch_size, n_query_points, seed=None):
         The (subsampled) data set along with its query points is
         returned.
     """
+    logger = logging.getLogger()
+
+    logger.info(f"Sampling a batch of {batch_size} points")
+    logger.info(f"Using {n_query_points} query points")
+
+    rng = np.random.default_rng(seed)
+
+    X = None
+    sampled = False
+
     if os.path.exists(filename):
         ext = os.path.splitext(filename)[1]
         if ext == ".txt" or ext == ".gz":
-            X = np.loadtxt(filename)
+            # Count rows first so that only the sampled rows have to be
+            # kept while parsing the file.
+            n_rows = _count_rows(filename)
+            indices = rng.choice(n_rows, batch_size, replace=False)
+
+            X = _read_rows(filename, indices)
+            sampled = True
+        elif ext == ".npy":
+            X = np.load(filename, mmap_mode="r")
         elif ext == ".npz":
             X = np.load(filename)["data"]
     else:
@@ -55,48 +78,108 @@ def load_data(filename, batch_size, n_query_points, seed=None):
         f"Unable to handle input file {filename}"
     )
 
-    logger = logging.getLogger()
+    # Indexing a memory-mapped array only reads the sampled rows.
+    if not sampled:
+        X = np.asarray(X[rng.choice(X.shape[0], batch_size, replace=False)])
 
-    logger.info(f"Sampling a batch of {batch_size} points")
-    logger.info(f"Using {n_query_points} query points")
-
-    rng = np.random.default_rng(seed)
-
-    X = X[rng.choice(X.shape[0], batch_size, replace=False)]
     query_points = X[rng.choice(X.shape[0], n_query_points, replace=False)]
 
     return X, query_points
 
 
-def estimate_scales(X, query_points, k_max):
+def _open(filename):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, "rt")
+    else:
+        return open(filename)
+
+
+def _count_rows(filename):
+    # Count rows in the same way as `np.loadtxt`, i.e. ignoring empty
+    # lines and comments.
+    with _open(filename) as f:
+        return sum(
+            1
+            for line in f
+            if line.strip() and not line.lstrip().startswith("#")
+        )
+
+
+def _read_rows(filename, indices, chunk_size=65536):
+    # Parse text file in chunks, keeping only the rows with the given
+    # indices, in the order of `indices`. Parsing stops after the last
+    # of these rows.
+    order = np.argsort(indices)
+    sorted_indices = indices[order]
+
+    X = None
+    start = 0
+
+    with _open(filename) as f, warnings.catch_warnings():
+        # Empty lines and comments do not count towards `max_rows`, which
+        # is what we want, but `np.loadtxt` warns about this.
+        warnings.filterwarnings("ignore", message="Input line")
+
+        while start <= sorted_indices[-1]:
+            chunk = np.loadtxt(f, max_rows=chunk_size, ndmin=2)
+            lo, hi = np.searchsorted(
+                sorted_indices, [start, start + len(chunk)]
+            )
+
+            if X is None:
+                X = np.empty((len(indices), chunk.shape[1]))
+
+            X[order[lo:hi]] = chunk[sorted_indices[lo:hi] - start]
+            start += len(chunk)
+
+    return X
+
+
+def estimate_scales(X, query_points, k_max, index=None, chunk_size=4096):
     """Perform simple scale estimation of the data set.
 
     Parameters
     ----------
+    X : np.array of shape ``(N, d)``
+        Input data set.
+
+    query_points : np.array of shape ``(M, d)``
+        Query points for which to estimate scales.
+
     k_max : int
         Maximum number of neighbours to consider for the local scale
         estimation.
 
+    index : :class:`tardis.neighbours.NeighbourIndex` or None
+        If set, use this index for nearest-neighbour queries instead of
+        building a new one. The index must have been built on `X`.
+
+    chunk_size : int
+        Number of query points to process at once. This bounds the
+        memory required for the distances of neighbours.
+
     Returns
     --------
-    List of dict
-        A list of dictionaries consisting of the minimum and maximum
-        inner and outer radius, respectively.
+    np.array of shape ``(M, 4)``
+        Minimum and maximum inner and outer radius, respectively, of
+        each query point, i.e. the columns correspond to the `r`, `R`,
+        `s`, and `S` parameters of :class:`Euclidicity`.
     """
-    tree = KDTree(X)
-    distances, _ = tree.query(query_points, k=k_max, return_distance=True)
-
-    # Ignore the distance to ourself, as we know that one already.
-    distances = distances[:, 1:]
-
-    scales = [
-        {
-            "r": dist[0],
-            "R": dist[round(k_max / 3)],
-            "s": dist[round(k_max / 3)],
-            "S": dist[-1],
-        }
-        for dist in distances
-    ]
+    if index is None:
+        index = NeighbourIndex(X)
+
+    query_points = np.asarray(query_points)
+    scales = np.empty((len(query_points), 4))
+
+    # Ignore the distance to ourself, as we know that one already. This
+    # shifts all indices of neighbours by one.
+    columns = [1, round(k_max / 3) + 1, round(k_max / 3) + 1, k_max - 1]
+
+    for start in range(0, len(query_points), chunk_size):
+        distances, _ = index.query(
+            query_points[start : start + chunk_size], k_max
+        )
+
+        scales[start : start + chunk_size] = distances[:, columns]
 
     return scales